@@ -1,40 +1,77 @@
 import os
 import sys
-import math
+import asyncio
 from datetime import datetime
-from collections import defaultdict
-from random import sample
 from flask import current_app, request
 from utils import get_data
+from utils import stream_data
+from utils import read_snapshot
 from utils import cleanup_data
 from utils import save_new_batch
 from utils import retrieve_article
 from utils import post_to_twitter
 from utils import update_main_library
+from utils import get_library_id
+from utils import get_twitter_api
+from utils import get_prior_articles
+from utils import EmptyBatchLibrary
 import paper_network
+import selection
+import batch_queue
+import instrumentation
 
-def generate_batch():
+def generate_batch(resync=False, snapshot=None, timer=None):
     # Initialize data structures
+    ## The measurements of the stages of this run
+    if timer is None:
+        timer = instrumentation.StageTimer()
     ## The current date
     current_date = datetime.now()
-    ## The dictionary that will hold the bibcodes in each cluster
-    cluster_members = defaultdict(list)
     ## The dictionary that contains the label for each cluster
     cluster_labels = {}
-    ## The dictionary that contains the necessary metadata for each bibcode
-    graph = {}
-    ## The list that will hold the candidates for the new batch
-    candidates = []
-    ## bibstems list to avoid papers from the same journal
-    bibstems = []
     # Retrieve the initial metadata from Solr (specify a year range)
     # Include the previous year in January
     if current_date.month == 1:
         year_range = "%s-%s" % (current_date.year - 1, current_date.year)
     else:
         year_range = str(current_date.year)
+    # With streaming enabled, the data is retrieved page by page while it is being consumed
+    # When a snapshot is specified, we run offline: the data is read from the snapshot, the
+    # local index of previously used publications is not synced and the batch is not saved
+    offline = snapshot is not None
+    # A network build can select the batches for several runs. The ones that are not used right
+    # away are queued, and as long as the queue does not run low, the next batch is taken from it.
+    batches_per_build = current_app.config.get('BATCHES_PER_BUILD', 1)
+    if batches_per_build > 1 and not offline and not resync:
+        with timer.stage('batch_queue') as stage:
+            queue = _batch_queue()
+            stage['counts']['batches'] = len(queue)
+            entries = None
+            if len(queue) > current_app.config.get('BATCH_QUEUE_LOW', 0):
+                entries = _pop_queued_batch(queue)
+        if entries is not None and len(entries) == 5:
+            new_batch = [(e['cluster'], e['bibcode']) for e in entries]
+            cluster_labels = dict((e['cluster'], e['label']) for e in entries)
+            post_message = _save_batch(new_batch, cluster_labels, timer, current_date,
+                                       note=' (from the batch queue, %s batches left)' % len(queue))
+            # The batch only leaves the queue once it was stored in the batch library
+            if 'Error' not in post_message:
+                _save_batch_queue(queue)
+            return post_message
+        if entries is not None:
+            current_app.logger.info('Queued batch has articles that were posted already, building a new network')
+            _save_batch_queue(queue)
+    # (with streaming, the time spent retrieving the data ends up in the 'network' stage)
     try:
-        data = get_data(year_range)
+        with timer.stage('get_data') as stage:
+            if offline:
+                data = read_snapshot(snapshot)
+            elif current_app.config.get('SOLR_STREAMING'):
+                data = stream_data(year_range)
+            else:
+                data = get_data(year_range)
+            if isinstance(data, list):
+                stage['counts']['documents'] = len(data)
     except:
         current_app.logger.exception("Failed to retrieve initial metadata from Solr")
         error = {
@@ -44,8 +81,10 @@ def generate_batch():
         return error
     # From the initial dataset, get the actual candidates by
     # 1. removing all publications that we used previously
+    #    (with 'resync', the local index of these publications is rebuilt from scratch)
     try:
-        clean_data = cleanup_data(data)
+        with timer.stage('cleanup_data'):
+            clean_data = cleanup_data(data, resync=resync, offline=offline)
     except:
         current_app.logger.exception("Failed to clean up data (remove publications used previously)")
         error = {
@@ -55,8 +94,17 @@ def generate_batch():
         return error
     # Create a paper network based on the candidates found
     # This network will be segmented into clusters. These clusters will be used to find candidates.
+    # The partition of the previous run is only updated for live runs, so that replaying a snapshot
+    # does not disturb it
+    partition_file = None
+    if not offline:
+        partition_file = current_app.config.get('PARTITION_FILE')
     try:
-        visdata = paper_network.get_papernetwork(clean_data, current_app.config.get("MAX_GROUPS"))
+        network = paper_network.get_clustered_network(clean_data, current_app.config.get("MAX_GROUPS"),
+                                                      timer=timer, partition_file=partition_file,
+                                                      compare_cold=current_app.config.get('PARTITION_COMPARE_COLD', False),
+                                                      clustering_backend=current_app.config.get('CLUSTERING_BACKEND', 'python-louvain'),
+                                                      clustering_seed=current_app.config.get('CLUSTERING_SEED'))
     except:
         current_app.logger.exception("Failed to create a paper network based on the candidates found")
         error = {
@@ -64,40 +112,34 @@ def generate_batch():
             'Slack':'@edwin Failed to create a paper network for the Article of the Day batch. Please check logs.'
         }
         return error
-    # Use the network to determine the new batch. The clustering is stored in the
-    # "summaryGraph" attribute, while the complete network in stored in "fullGraph".
+    # Use the network to determine the new batch. The summary of every cluster is stored in the
+    # "groups" attribute, while the group of every publication is stored in "group".
     #
-    # For each cluster, retrieve the keywords that describe its contents.
-    # It is possible not enough information is available to retrieve keywords
-    for summary_node in visdata['summaryGraph']['nodes']:
-        cluster_labels[summary_node['node_name']] = list(summary_node['node_label'].keys())
-    # Every node in the complete network represents a publication. The node name is the bibcode
-    # of the publication. The weight of the node within the network is determined from its
-    # indegree (number of citations), the number of authors and the 90-day reads. The weight
-    # closely resembles the "classic factor".
-    for node in visdata['fullGraph']['nodes']:
-        autnum = max(node['author_count'], 1)
-        citnum = node['citation_count']
-        rdsnum = node['read_count']
-        try:
-            weight = math.log10(1+(float(citnum + rdsnum)/float(autnum)))
-        except:
-            current_app.logger.exception("Failed to calculate weight for node {0}, switching to cite_read_boost".format(node['node_name']))
-            weight = float(node['cite_read_boost'])
-        cluster_members[node['group']].append((node['node_name'], weight))
-        # Here we store all attributes of each node to be accessed later on
-        graph[node['node_name']] = node
-    # Now we cycle through the clusters and build a list of candidates
-    for cluster,bibset in cluster_members.items():
-        candidate = bibset[0][0]
-        # we do a minimal effort to try to avoid multiple candidates from 1 journal
-        if candidate[4:9] in bibstems:
-            candidate = bibset[1][0]        
-        candidates.append((cluster, candidate))
-        bibstems.append(candidate[4:9])
-    # The new batch is a random pick of 5 from the candidates
-    try:
-        new_batch = sample(candidates, 5)
+    with timer.stage('selection') as stage:
+        # For each cluster, retrieve the keywords that describe its contents.
+        # It is possible not enough information is available to retrieve keywords
+        for cluster, summary in network.groups.items():
+            cluster_labels[cluster] = [l.decode("utf-8") if isinstance(l, bytes) else l for l in summary['node_label'].keys()]
+        # Every node in the top clusters represents a publication. The node name is the bibcode
+        # of the publication. The weight of the node within the network is determined from its
+        # indegree (number of citations), the number of authors and the 90-day reads. The weight
+        # closely resembles the "classic factor". The weights are determined for all nodes at once.
+        members, clusters = network.members()
+        weights = network.nodes.weights(members)
+        papers = [selection.Candidate(bibcode, author) for bibcode, author in
+                  zip(network.nodes.bibcode[members].tolist(), network.nodes.first_author[members].tolist())]
+        # For every cluster, we keep the papers with the largest weights as candidates
+        candidates = selection.top_papers(papers, clusters.tolist(), weights.tolist(),
+                                          k=current_app.config.get('SELECTION_TOP_K', 10))
+        stage['counts']['clusters'] = len(candidates)
+        stage['counts']['candidates'] = sum([len(c) for c in candidates.values()])
+    # The new batch is a pick of 5 candidates from different clusters (chosen at random), avoiding
+    # multiple candidates from 1 journal or by 1 first author. With BATCHES_PER_BUILD, the batches
+    # for the next runs are picked as well (without overlap)
+    try:
+        batches = selection.select_batches(candidates, batch_size=5, num_batches=batches_per_build,
+                                           diversity=current_app.config.get('SELECTION_DIVERSITY', selection.DEFAULT_DIVERSITY))
+        new_batch = batches[0] if len(batches) > 0 else []
     except:
         current_app.logger.exception('Failed to create new batch')
         error = {
@@ -113,9 +155,32 @@ def generate_batch():
             'Slack': '@edwin Found only %s articles instead of 5! Check logs!' % len(new_batch)
         }
         return error
+    # In offline mode we are done: report the new batch instead of storing it
+    if offline:
+        current_app.logger.info('Offline batch from snapshot {0}: {1}'.format(snapshot, ", ".join([e[1] for e in new_batch])))
+        current_app.logger.info('Stages:\n{0}'.format(timer.summary()))
+        return {'Batch': [e[1] for e in new_batch]}
     # Store the new batch in the appropriate ADS Library
+    post_message = _save_batch(new_batch, cluster_labels, timer, current_date)
+    # The other batches are queued, for the next runs
+    if batches_per_build > 1 and 'Error' not in post_message:
+        queued = [[{'cluster': cluster, 'bibcode': bibcode, 'label': cluster_labels.get(cluster, [])}
+                   for cluster, bibcode in batch] for batch in batches[1:] if len(batch) == 5]
+        try:
+            queue = _batch_queue()
+            queue.replace(queued, current_app.config.get('BATCH_QUEUE_TTL'))
+            queue.save()
+            current_app.logger.info('Queued {0} batches for the next runs'.format(len(queued)))
+        except:
+            current_app.logger.exception('Failed to store the batch queue')
+    return post_message
+
+def _save_batch(new_batch, cluster_labels, timer, current_date, note=''):
+    # Store the new batch in the appropriate ADS Library, and report it (with the labels
+    # of the clusters of its articles) on Slack
     try:
-        saved_batch = save_new_batch(new_batch)
+        with timer.stage('save_new_batch'):
+            saved_batch = save_new_batch(new_batch)
     except Exception as err:
         current_app.logger.error('Something went wrong saving the current AoD batch: {0}'.format(err))
         error = {
@@ -136,64 +201,186 @@ def generate_batch():
         }
         return error
     # For each candidate, include the keywords of the cluster it came from
-    subject = '<%s|Articles of the Day - batch %s/%s/%s>' % (saved_batch['library_url'], current_date.month, current_date.day,current_date.year)
+    subject = '<%s|Articles of the Day - batch %s/%s/%s>%s' % (saved_batch['library_url'], current_date.month, current_date.day,current_date.year, note)
     message = '```'
     for entry in new_batch:
         try:
-            label = "; ".join([l.decode("utf-8") for l in cluster_labels[entry[0]]])
+            label = "; ".join(cluster_labels[entry[0]])
         except:
             current_app.logger.exception("Failed to create label for cluster")
             label = "NA"
         message += "%s\tlabel: %s\n"%(entry[1],label)
     message += '```'
+    # Include how long each stage took, to keep an eye on how they grow with the volume of data
+    message += '\nStages:\n```%s```' % timer.summary()
     post_message = {
         'Slack': '@edwin %s\nEntries:\n%s' % (subject, message),
     }
     return post_message
 
+def _batch_queue():
+    queue = batch_queue.BatchQueue(current_app.config.get('BATCH_QUEUE_FILE'))
+    queue.expire()
+    return queue
+
+def _save_batch_queue(queue):
+    try:
+        queue.save()
+    except:
+        current_app.logger.exception('Failed to store the batch queue')
+
+def _pop_queued_batch(queue):
+    # Take the next batch from the queue, leaving out the articles that were posted in the
+    # meantime (according to the local index of posted articles, which is not synced here).
+    # The queue is not stored here: the caller does that once the batch was stored in the
+    # batch library, so that the batch is not lost when that fails.
+    return queue.pop(exclude=get_prior_articles(None, offline=True))
+
+def _refill_batch_library():
+    # Refill the empty batch library with the next batch from the batch queue. Returns a note
+    # on the refill for Slack (None if there is no queued batch).
+    queue = _batch_queue()
+    entries = _pop_queued_batch(queue)
+    if not entries:
+        return None
+    current_app.logger.info('Batch library is empty, refilling it from the batch queue')
+    saved_batch = save_new_batch([(e['cluster'], e['bibcode']) for e in entries])
+    # Check that all records were added, before the batch leaves the queue
+    try:
+        number_added = saved_batch['number_added']
+    except:
+        number_added = 0
+    if number_added != len(entries):
+        raise Exception('Failed to refill the batch library from the batch queue: {0} of {1} records added'.format(number_added, len(entries)))
+    _save_batch_queue(queue)
+    current_app.logger.info('Refilled the batch library from the batch queue: {0} ({1} batches left)'.format(
+        ", ".join([e['bibcode'] for e in entries]), len(queue)))
+    return 'Refilled the empty batch library from the batch queue: <%s|%s articles>, %s batches left' % (
+        saved_batch['library_url'], number_added, len(queue))
+
+def _retrieve_article(library_id=None):
+    # Get one article from the current batch. When the batch library is empty, it is refilled
+    # with the next batch from the batch queue (if there is one). Returns the article together
+    # with a note on the refill for Slack (None if there was no refill).
+    try:
+        return retrieve_article(library_id), None
+    except EmptyBatchLibrary:
+        refill = _refill_batch_library()
+        if refill is None:
+            raise
+        return retrieve_article(library_id), refill
+
+# The errors reported on Slack when a step of posting the Article of the Day fails
+POST_ERRORS = {
+    'prepare': 'Something went wrong preparing to post the Article of the Day',
+    'retrieve': 'Something went wrong retrieving the Article of the Day',
+    'twitter': 'Something went wrong posting the Article of the Day to Twitter',
+    'main library': 'Failed to update the Article of the Day main library',
+}
+
+def _post_error(step):
+    # Log the exception of a failed step and return the error for Slack
+    current_app.logger.exception(POST_ERRORS[step])
+    error = {
+        'Error':POST_ERRORS[step],
+        'Slack':'@edwin %s. Please check logs.' % POST_ERRORS[step]
+    }
+    return error
+
+def _twitter_error(twitter):
+    # The error for Slack when Twitter did not accept the post
+    error = {
+        'Error':'Unable to post the Article of the Day to Twitter',
+        'Slack': '@edwin Unable to post the Article of the Day to Twitter:\n%s'%twitter
+    }
+    return error
+
+def _posted_message(article_of_the_day, refill):
+    # The message for Slack after a successful post
+    current_app.logger.info('Successfully posted Article of the Day {0} to Twitter'.format(article_of_the_day))
+    post_message = {
+        'Slack':'Successfully posted Article of the Day {0} to Twitter'.format(article_of_the_day['bibcode'])
+    }
+    if refill is not None:
+        post_message['Slack'] += '\n%s' % refill
+    return post_message
+
 def post_article():
     # Get one article from the current batch
     try:
-        article_of_the_day = retrieve_article()
+        article_of_the_day, refill = _retrieve_article()
     except:
-        current_app.logger.exception('Something went wrong retrieving the Article of the Day')
-        error = {
-            'Error':'Something went wrong retrieving the Article of the Day',
-            'Slack':'@edwin Something went wrong retrieving the Article of the Day. Please check logs.'
-        }
-        return error
+        return _post_error('retrieve')
     # Now we can start posting the article
     # 1. post to Twitter
     try:
         twitter = post_to_twitter(article_of_the_day)
     except:
-        current_app.logger.exception('Something went wrong posting the Article of the Day to Twitter')
-        error = {
-            'Error':'Something went wrong posting the Article of the Day to Twitter',
-            'Slack':'@edwin Something went wrong posting the Article of the Day to Twitter. Please check logs.'
-        }
-        return error
+        return _post_error('twitter')
     if not twitter:
-        error = {
-            'Error':'Unable to post the Article of the Day to Twitter',
-            'Slack': '@edwin Unable to post the Article of the Day to Twitter:\n%s'%twitter
-        }
-        return error
+        return _twitter_error(twitter)
     # With a successful post we add this article to the library containing all the articles
     # that have been posted
     try:
-        res = update_main_library(article_of_the_day['bibcode'])
+        update_main_library(article_of_the_day['bibcode'])
     except:
-        current_app.logger.exception('Failed to update the Article of the Day main library')
-        error = {
-            'Error':'Failed to update the Article of the Day main library',
-            'Slack':'@edwin Failed to update the Article of the Day main library. Please check logs.'
-        }
-        return error
-    current_app.logger.info('Successfully posted Article of the Day {0} to Twitter'.format(article_of_the_day))
-    post_message = {
-        'Slack':'Successfully posted Article of the Day {0} to Twitter'.format(article_of_the_day['bibcode'])
-    }
-    return post_message
-        
-        
+        return _post_error('main library')
+    return _posted_message(article_of_the_day, refill)
+
+
+async def _run_step(app, timeout, func, *args):
+    # Run a blocking step in a worker thread (with its own application context), giving up
+    # after 'timeout' seconds (no timeout if it is None). Note that a step that timed out is not
+    # interrupted, we just stop waiting for it.
+    def call():
+        with app.app_context():
+            return func(*args)
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(loop.run_in_executor(None, call), timeout)
+
+async def _post_article(app):
+    # The steps of post_article. This runs in the application context of post_article_async,
+    # the blocking steps run in worker threads.
+    api_token = app.config.get('API_TOKEN')
+    timeout = app.config.get('POST_STEP_TIMEOUT')
+    # The lookups of the library IDs and the preparation of the Twitter client are independent,
+    # so they are done concurrently
+    try:
+        batch_library_id, main_library_id, twitter_api = await asyncio.gather(
+            _run_step(app, timeout, get_library_id, api_token, app.config.get('BATCH_LIBRARY_NAME')),
+            _run_step(app, timeout, get_library_id, api_token, app.config.get('AOD_LIBRARY_NAME')),
+            _run_step(app, timeout, get_twitter_api))
+    except:
+        return _post_error('prepare')
+    # Get one article from the current batch. This step has no timeout: the article is taken
+    # from the batch (and a refill may be stored) even if we stopped waiting for it
+    try:
+        article_of_the_day, refill = await _run_step(app, None, _retrieve_article, batch_library_id)
+    except:
+        return _post_error('retrieve')
+    # Now we can start posting the article
+    # 1. post to Twitter. This step has no timeout either: a post we stopped waiting for could
+    #    still go out, and the article would then never be recorded in the main library
+    try:
+        twitter = await _run_step(app, None, post_to_twitter, article_of_the_day, twitter_api)
+    except:
+        return _post_error('twitter')
+    if not twitter:
+        return _twitter_error(twitter)
+    # With a successful post we add this article to the library containing all the articles
+    # that have been posted
+    try:
+        await _run_step(app, timeout, update_main_library, article_of_the_day['bibcode'], main_library_id)
+    except:
+        return _post_error('main library')
+    return _posted_message(article_of_the_day, refill)
+
+def post_article_async():
+    # Same as post_article, but the independent lookups are done concurrently and the lookups
+    # and the update of the main library are subject to a timeout (POST_STEP_TIMEOUT)
+    app = current_app._get_current_object()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_post_article(app))
+    finally:
+        loop.close()
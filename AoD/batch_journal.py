@@ -0,0 +1,97 @@
+'''
+Local journal of the current batch of articles. It is written when a new batch is saved in the
+batch library, with the metadata needed to post the articles, so that posting an article does not
+have to wait for the libraries API. The articles taken from the journal are removed from the batch
+library afterwards (write-behind), with retries; until then they are kept as pending removals.
+'''
+import os
+import json
+import time
+import sqlite3
+
+class BatchJournal(object):
+    """Persistent journal of the articles in the current batch, in batch order, with the articles
+    that were taken from it but not removed from the batch library yet"""
+
+    def __init__(self, path):
+        """Constructor"""
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS articles (position INTEGER PRIMARY KEY, bibcode TEXT, "
+                          "metadata TEXT, taken REAL, synced INTEGER DEFAULT 0, attempts INTEGER DEFAULT 0)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS batch (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+    def library_id(self):
+        """The ID of the batch library the journal corresponds with (None if there is no batch)"""
+        row = self.conn.execute("SELECT value FROM batch WHERE key = 'library_id'").fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def replace(self, library_id, articles):
+        """Start the journal of a new batch, with the metadata of its articles (in batch order). The
+        pending removals of the previous batch are kept when it is in the same library."""
+        with self.conn:
+            if library_id != self.library_id():
+                self.conn.execute("DELETE FROM articles")
+            else:
+                self.conn.execute("DELETE FROM articles WHERE taken IS NULL OR synced = 1")
+            start = self.conn.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM articles").fetchone()[0]
+            self.conn.executemany("INSERT INTO articles (position, bibcode, metadata) VALUES (?, ?, ?)",
+                                  [(start + i, a['bibcode'], json.dumps(a)) for i, a in enumerate(articles)])
+            self.conn.execute("INSERT OR REPLACE INTO batch (key, value) VALUES ('library_id', ?)", (library_id,))
+            self.conn.execute("INSERT OR REPLACE INTO batch (key, value) VALUES ('created', ?)", (str(time.time()),))
+
+    def reset(self):
+        """Empty the journal, so that the batch library is used directly"""
+        with self.conn:
+            self.conn.execute("DELETE FROM articles")
+            self.conn.execute("DELETE FROM batch")
+
+    def discard_remaining(self):
+        """Drop the articles that were not taken yet, keeping the pending removals, so that the
+        batch library is used directly"""
+        with self.conn:
+            self.conn.execute("DELETE FROM articles WHERE taken IS NULL")
+
+    def remaining(self):
+        """The number of articles that were not taken yet"""
+        return self.conn.execute("SELECT COUNT(*) FROM articles WHERE taken IS NULL").fetchone()[0]
+
+    def take(self):
+        """Take the next article from the batch (None if all articles were taken), which makes it
+        a pending removal"""
+        with self.conn:
+            row = self.conn.execute("SELECT position, metadata FROM articles WHERE taken IS NULL "
+                                    "ORDER BY position LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE articles SET taken = ? WHERE position = ?", (time.time(), row[0]))
+        return json.loads(row[1])
+
+    def pending_removals(self):
+        """The bibcodes of the articles that were taken but not removed from the batch library yet"""
+        return [row[0] for row in self.conn.execute("SELECT bibcode FROM articles WHERE taken IS NOT NULL "
+                                                    "AND synced = 0 ORDER BY position")]
+
+    def mark_synced(self, bibcodes):
+        """Record that these articles were removed from the batch library"""
+        with self.conn:
+            self.conn.executemany("UPDATE articles SET synced = 1 WHERE bibcode = ?", [(b,) for b in bibcodes])
+
+    def mark_failed(self, bibcodes):
+        """Record a failed attempt to remove these articles from the batch library"""
+        with self.conn:
+            self.conn.executemany("UPDATE articles SET attempts = attempts + 1 WHERE bibcode = ?", [(b,) for b in bibcodes])
+
+    def failed_attempts(self):
+        """The largest number of failed attempts to remove one of the pending removals from the
+        batch library (zero if there are none)"""
+        row = self.conn.execute("SELECT MAX(attempts) FROM articles WHERE taken IS NOT NULL AND synced = 0").fetchone()
+        return row[0] or 0
+
+    def close(self):
+        self.conn.close()
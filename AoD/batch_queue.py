@@ -0,0 +1,56 @@
+'''
+Local queue of batches that were selected in advance. A single network build can produce the
+batches for several periods (see BATCHES_PER_BUILD in config.py): the first one is stored in the
+batch library right away, the others are queued here. Queued batches expire after a while,
+because the set of recent publications the network was built from keeps moving.
+'''
+import time
+import logging
+
+import local_files
+
+logger = logging.getLogger(__name__)
+
+class BatchQueue(object):
+    """Persistent queue of batches, each a list of entries with the cluster, the bibcode and the
+    cluster label of a candidate, stored as a JSON file"""
+
+    def __init__(self, path):
+        """Constructor"""
+        self.path = path
+        self.batches = self.__load()
+
+    def __load(self):
+        """The batches in the file (an empty queue if there is no usable file)"""
+        return local_files.read_json(self.path, {}).get('batches', [])
+
+    def save(self):
+        """Store the queue, replacing the file atomically"""
+        local_files.write_json(self.path, {'batches': self.batches})
+
+    def expire(self, now=None):
+        """Remove the batches that have expired"""
+        if now is None:
+            now = time.time()
+        expired = [b for b in self.batches if b['expires'] <= now]
+        if len(expired) > 0:
+            logger.info('Dropping {0} expired batches from the batch queue'.format(len(expired)))
+            self.batches = [b for b in self.batches if b['expires'] > now]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def replace(self, batches, ttl, now=None):
+        """Replace the contents of the queue with new batches, which expire after 'ttl' seconds"""
+        if now is None:
+            now = time.time()
+        self.batches = [{'created': now, 'expires': now + ttl, 'entries': entries} for entries in batches]
+
+    def pop(self, exclude=frozenset()):
+        """Take the next batch from the queue (None if it is empty), without the entries with a
+        bibcode in 'exclude' (like the articles that have been posted in the meantime)"""
+        self.expire()
+        if len(self.batches) == 0:
+            return None
+        batch = self.batches.pop(0)
+        return [entry for entry in batch['entries'] if entry['bibcode'] not in exclude]
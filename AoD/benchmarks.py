@@ -0,0 +1,200 @@
+'''
+Benchmarks for the paper network machinery, based on synthetic data
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+import subprocess
+
+import numpy
+
+import paper_network
+import tf_idf
+import histeq
+import synthetic
+import clustering
+
+def _synthetic_group_graph(num_nodes, num_edges, num_groups=10, refs_per_node=20, num_refs=1000, seed=42):
+    '''
+    Generate a random graph (as link arrays) with a random assignment of groups and a random set
+    of references for every node
+    '''
+    rnd = random.Random(seed)
+    edges = set()
+    while len(edges) < num_edges:
+        paper_one, paper_two = rnd.randrange(num_nodes), rnd.randrange(num_nodes)
+        if paper_one != paper_two:
+            edges.add((min(paper_one, paper_two), max(paper_one, paper_two)))
+    edges = sorted(edges)
+    source = numpy.array([e[0] for e in edges], dtype=int)
+    target = numpy.array([e[1] for e in edges], dtype=int)
+    group = numpy.array([rnd.randrange(num_groups) for paper in range(num_nodes)], dtype=int)
+    reference_sets = [set(['R%s' % r for r in rnd.sample(range(num_refs), refs_per_node)]) for paper in range(num_nodes)]
+    return source, target, group, reference_sets
+
+def benchmark_group_aggregation(edge_counts=(25000, 50000, 100000, 200000), num_nodes=5000, repeat=3):
+    '''
+    Time the group index and co-reference aggregation of augment_graph_data for an increasing
+    number of edges. The time per edge should stay (roughly) constant.
+    '''
+    results = []
+    for num_edges in edge_counts:
+        source, target, group, reference_sets = _synthetic_group_graph(num_nodes, num_edges)
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            group_members, group_edges = paper_network._index_groups(group, source, target)
+            for g in group_members:
+                num_papers = float(len(group_members[g]))
+                paper_network._get_common_references(group_edges[g], reference_sets, num_papers)
+            timings.append(time.time() - start)
+        best = min(timings)
+        results.append((num_edges, best))
+        sys.stdout.write("%10d edges %10.3f s %10.3f us/edge\n" % (num_edges, best, 1e6*best/num_edges))
+    return results
+
+def _measure(repeat, func, *args, **kwargs):
+    '''
+    Run a function 'repeat' times and return its result with the best wall time (in seconds). The
+    peak memory allocated by the function (in bytes) is measured in a separate run, because
+    tracing allocations slows things down considerably.
+    '''
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, min(timings), peak
+
+def _git_commit():
+    '''
+    The commit of the working tree, so that results can be compared across commits
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+def benchmark_pipeline(sizes=(1000, 5000, 20000, 50000), max_groups=10, repeat=1, seed=42, output=None):
+    '''
+    Time and memory profile the stages of the paper network pipeline on synthetic corpora of
+    increasing size, for all combinations of the 'weighted' and 'equalization' options:
+    get_papernetwork (end-to-end), augment_graph_data (on the network built beforehand), tf-idf
+    on the titles of every topic and the histogram equalization of the link forces. The results
+    are written as JSON to 'output' (if specified) and returned.
+    '''
+    results = []
+    def run(stage, num_papers, network, weighted, equalization, func):
+        result, seconds, peak = _measure(repeat, func)
+        record = {
+            'stage': stage,
+            'papers': num_papers,
+            'nodes': len(network.nodes),
+            'links': len(network.force),
+            'weighted': weighted,
+            'equalization': equalization,
+            'seconds': seconds,
+            'peak_memory': peak,
+        }
+        results.append(record)
+        sys.stdout.write("%8d papers %9d links weighted=%-5s equalization=%-5s %-20s %10.3f s %10.1f MB\n" % (
+            num_papers, record['links'], weighted, equalization, stage, seconds, peak/1e6))
+    for num_papers in sizes:
+        docs = synthetic.solr_docs(num_papers, seed=seed)
+        for weighted in (True, False):
+            for equalization in (False, True):
+                network, reference_sets = paper_network._build_network(docs, weighted=weighted, equalization=equalization)
+                run('get_papernetwork', num_papers, network, weighted, equalization,
+                    lambda: paper_network.get_papernetwork(docs, max_groups, weighted=weighted, equalization=equalization))
+                run('augment_graph_data', num_papers, network, weighted, equalization,
+                    lambda: paper_network.augment_graph_data(network, max_groups, reference_sets=reference_sets))
+        # The remaining stages do not depend on the options: tf-idf for the titles of the
+        # papers divided over the groups, and the histogram equalization of the weighted forces
+        network, reference_sets = paper_network._build_network(docs)
+        groups = {}
+        for i, doc in enumerate(docs):
+            groups.setdefault(i % max_groups, []).append(doc['title'][0])
+        forces = paper_network._get_link_dictionary(network.names(), network.source, network.target, network.force)
+        run('tf_idf', num_papers, network, None, None, lambda: tf_idf.get_tf_idf_vals(groups))
+        run('hist_eq', num_papers, network, None, None, lambda: histeq.HistEq(forces).hist_eq())
+    if output is not None:
+        _write_report(output, results, seed, repeat)
+    return results
+
+def benchmark_clustering(sizes=(1000, 5000, 20000), backends=None, repeat=1, seed=42, output=None):
+    '''
+    Time the clustering backends on the (weighted) paper networks of synthetic corpora of increasing
+    size, and report the modularity and the number of communities of the partitions they find.
+    The results are written as JSON to 'output' (if specified) and returned.
+    '''
+    if backends is None:
+        backends = sorted(clustering.BACKENDS)
+    results = []
+    for num_papers in sizes:
+        network, reference_sets = paper_network._build_network(synthetic.solr_docs(num_papers, seed=seed))
+        # The graph is only used for the backends that need it, and to determine the modularity
+        G = network.graph()
+        A = network.adjacency()
+        for backend in backends:
+            data = G if clustering.uses_graph(backend) else A
+            partition, seconds, peak = _measure(repeat, clustering.get_partition, data, backend=backend, seed=seed)
+            record = {
+                'backend': backend,
+                'papers': num_papers,
+                'nodes': G.number_of_nodes(),
+                'links': G.number_of_edges(),
+                'seconds': seconds,
+                'peak_memory': peak,
+                'modularity': clustering.modularity(G, partition),
+                'communities': len(set(partition.values())),
+            }
+            results.append(record)
+            sys.stdout.write("%8d papers %9d links %-20s %10.3f s %10.1f MB modularity %.4f %6d communities\n" % (
+                num_papers, record['links'], backend, seconds, peak/1e6, record['modularity'], record['communities']))
+    if output is not None:
+        _write_report(output, results, seed, repeat)
+    return results
+
+def _write_report(output, results, seed, repeat):
+    '''
+    Write benchmark results as JSON, together with the commit and Python version they apply to
+    '''
+    report = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'seed': seed,
+        'repeat': repeat,
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the paper network machinery')
+    parser.add_argument('benchmark', nargs='?', choices=['pipeline', 'groups', 'clustering'], default='pipeline')
+    parser.add_argument('--sizes', default='1000,5000,20000,50000',
+                        help='Comma separated list of the numbers of papers in the synthetic corpora')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of timed runs per stage (the best one counts)')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for the synthetic corpora')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this file')
+    args = parser.parse_args()
+    if args.benchmark == 'groups':
+        benchmark_group_aggregation()
+    elif args.benchmark == 'clustering':
+        benchmark_clustering(sizes=[int(n) for n in args.sizes.split(',')], repeat=args.repeat,
+                             seed=args.seed, output=args.output)
+    else:
+        benchmark_pipeline(sizes=[int(n) for n in args.sizes.split(',')], repeat=args.repeat,
+                           seed=args.seed, output=args.output)
@@ -1,10 +1,60 @@
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from flask import current_app, request
 
 requests.packages.urllib3.disable_warnings()
 
 client = lambda: Client(current_app.config)
 
+# The session shared by all clients in this process
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session(config):
+    """
+    Return the process-wide session, creating it on first use. All clients share its
+    connection pools, so that connections are kept alive and reused across requests
+    :param config: configuration dictionary used to set up the connection pools
+    :return: requests.Session instance
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=config.get('HTTP_POOL_CONNECTIONS', 10),
+                                  pool_maxsize=config.get('HTTP_POOL_MAXSIZE', 10))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip'
+            if config.get('HTTP_KEEP_ALIVE', True):
+                session.headers['Connection'] = 'keep-alive'
+            else:
+                session.headers['Connection'] = 'close'
+            _session = session
+    return _session
+
+
+def connection_stats():
+    """
+    Connection reuse statistics of the shared session
+    :return: dictionary with the number of requests made, the number of connections
+             opened (each one a TCP+TLS handshake) and the number of requests that reused
+             an existing connection
+    """
+    stats = {'requests': 0, 'connections': 0, 'reused': 0}
+    if _session is None:
+        return stats
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+    stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+    return stats
+
 
 class Client:
     """
@@ -18,7 +68,7 @@ class Client:
         :param client_config: configuration dictionary of the client
         """
 
-        self.session = requests.Session()
+        self.session = _get_session(config)
 
     def _sanitize(self, args, kwargs):
         headers = kwargs.get('headers', {})
@@ -30,7 +80,7 @@ class Client:
     def get(self, *args, **kwargs):
         args, kwargs = self._sanitize(args, kwargs)
         return self.session.get(*args, **kwargs)
-    
+
     def post(self, *args, **kwargs):
         args, kwargs = self._sanitize(args, kwargs)
         return self.session.post(*args, **kwargs)
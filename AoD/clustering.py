@@ -0,0 +1,232 @@
+'''
+Community detection backends for the paper network. Every backend takes the network and a seed, and
+returns a partition: a dictionary with the community of every node. The Louvain backend takes the
+network as a weighted networkx graph, the others work directly on its weighted adjacency matrix (a
+scipy.sparse CSR matrix, see paper_network.PaperNetwork.adjacency), with the nodes numbered 0..n-1.
+'''
+import logging
+
+import numpy
+import community
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, eigsh
+
+logger = logging.getLogger(__name__)
+
+def _partition_from_communities(communities):
+    '''
+    Turn a collection of sets of nodes into a partition (largest communities first)
+    '''
+    partition = {}
+    for label, members in enumerate(sorted(communities, key=lambda c: (-len(c), min(c)))):
+        for node in members:
+            partition[node] = label
+    return partition
+
+def python_louvain(G, seed=None, partition=None):
+    '''
+    The Louvain method as implemented by python-louvain, optionally starting from a partition
+    '''
+    return community.best_partition(G, partition=partition, random_state=seed)
+
+def _degrees(A):
+    '''
+    The node degrees and the total degree of the network with weighted adjacency matrix A
+    '''
+    k = numpy.asarray(A.sum(axis=1)).ravel()
+    return k, k.sum()
+
+def _modularity(A, k, total, labels):
+    '''
+    The modularity of a labelling of the nodes of the graph with adjacency matrix A
+    '''
+    n = len(labels)
+    P = sparse.csr_matrix((numpy.ones(n), (numpy.arange(n), labels)), shape=(n, labels.max() + 1))
+    internal = (P.T * A * P).diagonal()
+    degrees = P.T * k
+    return (internal / total - (degrees / total)**2).sum()
+
+def _best_moves(A, k, total, labels, update):
+    '''
+    For the nodes 'update', the label (of a neighbour, or their own label) that gives the largest
+    modularity when the node is moved into it on its own: the weight of its links to the nodes with
+    that label, minus the expected weight k_i*K_label/total. Only the labels of the neighbours are
+    considered, so this works with sparse matrices.
+    '''
+    n = len(labels)
+    num_labels = labels.max() + 1
+    P = sparse.csr_matrix((numpy.ones(n), (numpy.arange(n), labels)), shape=(n, num_labels))
+    # The weight of the links of every node to every label of its neighbours, with an explicit
+    # (possibly zero) entry for its own label
+    rows = numpy.arange(len(update))
+    links = (A[update] * P).tocoo()
+    links = sparse.coo_matrix((numpy.concatenate([links.data, numpy.zeros(len(update))]),
+                               (numpy.concatenate([links.row, rows]), numpy.concatenate([links.col, labels[update]]))),
+                              shape=links.shape).tocsr().tocoo()
+    # The total degree of every label, without the node itself
+    degrees = (P.T * k)[links.col] - numpy.where(links.col == labels[update][links.row], k[update][links.row], 0)
+    gain = links.data - k[update][links.row] * degrees / total
+    # Staying has a slight preference, so that nodes do not move on ties
+    gain[links.col == labels[update][links.row]] += 1e-12
+    best = numpy.lexsort((-gain, links.row))
+    first = numpy.ones(len(best), dtype=bool)
+    first[1:] = links.row[best][1:] != links.row[best][:-1]
+    return links.col[best][first]
+
+def _relabel(labels):
+    '''
+    Number the labels consecutively
+    '''
+    return numpy.unique(labels, return_inverse=True)[1]
+
+def _communities(labels):
+    '''
+    The partition of the nodes corresponding with a labelling
+    '''
+    return _partition_from_communities([set(numpy.nonzero(labels == label)[0].tolist())
+                                        for label in numpy.unique(labels)])
+
+def label_propagation(A, seed=None, partition=None, max_iterations=100):
+    '''
+    Label propagation with a modularity penalty (LPAm, Barber & Clark 2009): every node takes
+    the label of its neighbours with the largest weight of links to it, minus the weight expected
+    from the degrees. Without this penalty, a few labels take over the entire (dense) co-citation
+    network. In every iteration a random half of the nodes is updated, all at once with sparse
+    matrix products, which avoids the oscillations of fully synchronous updates.
+    '''
+    k, total = _degrees(A)
+    n = A.shape[0]
+    if total == 0:
+        return dict((node, node) for node in range(n))
+    rnd = numpy.random.RandomState(seed)
+    labels = numpy.arange(n)
+    unchanged = 0
+    for i in range(max_iterations):
+        update = numpy.nonzero((k > 0) & (rnd.random_sample(n) < 0.5))[0]
+        new_labels = _best_moves(A, k, total, labels, update)
+        changed = (new_labels != labels[update]).any()
+        labels[update] = new_labels
+        labels = _relabel(labels)
+        # Stop when the labels did not change in two consecutive iterations
+        unchanged = 0 if changed else unchanged + 1
+        if unchanged == 2:
+            break
+    return _communities(labels)
+
+def _modularity_matrix(A, k, total, members):
+    '''
+    The modularity matrix of the subgraph 'members' of the graph with adjacency matrix A, node
+    degrees k and total degree 'total' (Newman 2006), as a function that applies it to a vector:
+    B_ij = A_ij - k_i*k_j/total - delta_ij*sum_l (A_il - k_i*k_l/total), with i, j, l in 'members'.
+    The (dense) matrix itself is never constructed.
+    '''
+    A_g = A[members][:, members]
+    k_g = k[members]
+    diagonal = numpy.asarray(A_g.sum(axis=1)).ravel() - k_g * k_g.sum() / total
+    return lambda x: A_g.dot(x) - k_g * k_g.dot(x) / total - diagonal * x
+
+def _leading_eigenvector(matvec, n, rnd):
+    '''
+    The leading eigenvalue and eigenvector of a symmetric n x n matrix, given as a function
+    that applies it to a vector
+    '''
+    if n <= 64:
+        # For small matrices, a dense eigendecomposition is faster and more robust
+        B = numpy.column_stack([matvec(e) for e in numpy.eye(n)])
+        values, vectors = numpy.linalg.eigh(B)
+        return values[-1], vectors[:, -1]
+    B = LinearOperator((n, n), matvec=matvec, dtype=float)
+    values, vectors = eigsh(B, k=1, which='LA', v0=rnd.uniform(-1, 1, n), tol=1e-6)
+    return values[0], vectors[:, 0]
+
+def _refine(A, k, total, labels, iterations=10):
+    '''
+    Improve a labelling of the nodes by moving all nodes at once to the neighbouring community with
+    the largest gain in modularity, as long as the modularity increases
+    '''
+    everything = numpy.arange(len(labels))
+    quality = _modularity(A, k, total, labels)
+    for i in range(iterations):
+        candidate = _relabel(_best_moves(A, k, total, labels, everything))
+        candidate_quality = _modularity(A, k, total, candidate)
+        if candidate_quality <= quality:
+            break
+        labels, quality = candidate, candidate_quality
+    return labels
+
+def spectral_modularity(A, seed=None, partition=None):
+    '''
+    Newman's leading eigenvector method: communities are split in two, along the sign of the
+    leading eigenvector of their modularity matrix, as long as this increases the modularity.
+    The result is refined by moving nodes between communities. This works directly on the sparse
+    weighted adjacency matrix of the network.
+    '''
+    k, total = _degrees(A)
+    n = A.shape[0]
+    if total == 0:
+        return dict((node, node) for node in range(n))
+    rnd = numpy.random.RandomState(seed)
+    communities = []
+    queue = [numpy.arange(n)]
+    while queue:
+        members = queue.pop()
+        if len(members) < 2:
+            communities.append(members)
+            continue
+        matvec = _modularity_matrix(A, k, total, members)
+        value, vector = _leading_eigenvector(matvec, len(members), rnd)
+        split = vector > 0
+        if value <= 1e-8 or split.all() or not split.any():
+            communities.append(members)
+            continue
+        # The change in modularity of the split is s_t*B*s/(2*total), with s the +1/-1 split vector
+        s = numpy.where(split, 1.0, -1.0)
+        if s.dot(matvec(s)) / (2 * total) <= 1e-10:
+            communities.append(members)
+            continue
+        queue.append(members[split])
+        queue.append(members[~split])
+    labels = numpy.zeros(n, dtype=int)
+    for label, members in enumerate(communities):
+        labels[members] = label
+    labels = _refine(A, k, total, labels)
+    return _communities(labels)
+
+BACKENDS = {
+    'python-louvain': python_louvain,
+    'label-propagation': label_propagation,
+    'spectral': spectral_modularity,
+}
+
+# The backends that can start from the partition of a previous run
+WARM_START_BACKENDS = frozenset(['python-louvain'])
+# The backends that take the network as a networkx graph (the others take its adjacency matrix)
+GRAPH_BACKENDS = frozenset(['python-louvain'])
+
+def _check_backend(backend):
+    '''
+    Check that the backend exists
+    '''
+    if backend not in BACKENDS:
+        raise ValueError('Unknown clustering backend "{0}", choose from {1}'.format(backend, ", ".join(sorted(BACKENDS))))
+    return backend
+
+def uses_graph(backend):
+    '''
+    Whether the backend takes the network as a networkx graph (otherwise it takes its adjacency matrix)
+    '''
+    return _check_backend(backend) in GRAPH_BACKENDS
+
+def get_partition(network, backend='python-louvain', seed=None, partition=None):
+    '''
+    Find the communities in the network with the specified backend (see BACKENDS), given as a
+    networkx graph or as an adjacency matrix (see uses_graph). The initial 'partition' is only
+    used by the backends that support it.
+    '''
+    return BACKENDS[_check_backend(backend)](network, seed=seed, partition=partition)
+
+def modularity(G, partition):
+    '''
+    The modularity of a partition of the (weighted) graph
+    '''
+    return community.modularity(partition, G)
@@ -1,15 +1,67 @@
+import os
+
 API_TOKEN = "your token"
 SLACK_END_POINT = 'https://hooks.slack.com/services/TOKEN/TOKEN'
 SOLR_PATH = 'https://api.adsabs.harvard.edu/v1/search/query'
 LIBRARY_PATH = 'https://api.adsabs.harvard.edu/v1/biblib'
 ADS_LIBRARY_PATH = 'https://ui.adsabs.harvard.edu/public-libraries'
 ABSTRACT_PATH = 'https://ui.adsabs.harvard.edu/#abs'
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 10
+HTTP_KEEP_ALIVE = True
 QUERY = 'entry_date:["NOW-21DAYS" TO NOW] collection:astronomy doctype:article'
 FIELDS = 'bibcode,year,citation_count,read_count,author_count,cite_read_boost,keywords,title,abstract,authors_norm,first_author,reference'
 MAX_HITS = 1000
+SOLR_STREAMING = False
+SOLR_PAGE_SIZE = 500
+SOLR_MAX_DOCS = 5000
+SOLR_CURSOR_SORT = 'citation_count_norm desc,id asc'
 MAX_GROUPS = 10
+# The candidates for a batch are the SELECTION_TOP_K papers with the largest weights in every cluster.
+# The papers in a batch come from different clusters and do not share the attributes in
+# SELECTION_DIVERSITY ('bibstem' and/or 'first_author'), as far as possible.
+SELECTION_TOP_K = 10
+SELECTION_DIVERSITY = ['bibstem', 'first_author']
+# A single network build can select the batches for several runs: the first batch is stored in the batch
+# library, the others are queued locally and expire after BATCH_QUEUE_TTL seconds (as the set of recent
+# publications moves on). The 'generate' command takes the next batch from the queue and only builds a
+# new network when the queue holds no more than BATCH_QUEUE_LOW batches. The 'post' command refills an
+# empty batch library from the queue.
+BATCHES_PER_BUILD = 1
+BATCH_QUEUE_TTL = 14*24*3600
+BATCH_QUEUE_LOW = 0
 AOD_LIBRARY_NAME = 'ADS Articles of the Day'
 BATCH_LIBRARY_NAME = 'Current ADS Article of the Day batch'
+LIBRARY_PAGE_SIZE = 100
+LIBRARY_FETCH_CONCURRENCY = 4
+# The sort used to sync the local index of posted articles with the library (the oldest additions first),
+# so that the records added since the last sync are at the end
+LIBRARY_SYNC_SORT = 'time asc'
+# Local files used to cache data between runs
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+LIBRARY_ID_CACHE_FILE = os.path.join(CACHE_DIR, 'library_ids.json')
+LIBRARY_ID_CACHE_TTL = 7*24*3600
+POSTED_INDEX_FILE = os.path.join(CACHE_DIR, 'posted_articles.sqlite')
+POSTED_INDEX_RESYNC_AGE = 7*24*3600
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, 'snapshots')
+# Maximum age (in seconds) of a Solr data snapshot to be reused; 0 disables snapshots. Snapshots are
+# written by live runs (also with SOLR_STREAMING) and removed after SNAPSHOT_RETENTION seconds (None keeps them)
+SNAPSHOT_TTL = 6*3600
+SNAPSHOT_RETENTION = 7*24*3600
+BATCH_QUEUE_FILE = os.path.join(CACHE_DIR, 'batch_queue.json')
+BATCH_JOURNAL_FILE = os.path.join(CACHE_DIR, 'batch_journal.sqlite')
+# The clustering starts from the partition of the previous run, stored in this file (None for a
+# cold start every run). With PARTITION_COMPARE_COLD a cold start is timed as well, for comparison.
+PARTITION_FILE = os.path.join(CACHE_DIR, 'partition.json')
+PARTITION_COMPARE_COLD = False
+# The method used to find the clusters in the paper network: 'python-louvain', 'label-propagation'
+# or 'spectral' (see clustering.py), with a fixed seed for reproducible results
+CLUSTERING_BACKEND = 'python-louvain'
+CLUSTERING_SEED = 42
+# File to write the measurements of the stages of the batch generation to (if set), either as
+# JSON ('json') or as a Prometheus textfile ('prometheus')
+METRICS_FILE = None
+METRICS_FORMAT = 'json'
 AOD_UTM_TAGS = 'utm_source=pyscript&utm_medium=tweet&utm_campaign=ADSaotd&utm_content=aotd'
 TWITTER_TAG = '#ADSarticleOfTheDay'
 TWITTER_CONSUMER_KEY = 'consumerkey'
@@ -18,3 +70,25 @@ TWITTER_ACCESS_KEY = 'accesskey'
 TWITTER_ACCESS_SECRET = 'accesssecret'
 TWITTER_POST_LENGTH = 280
 TWITTER_URL_LENGTH = 23
+# Post with the asyncio based pipeline, in which the library lookups and updates have a timeout (in seconds)
+POST_ASYNC = False
+POST_STEP_TIMEOUT = 60
+# The articles are taken from the local journal of the current batch (BATCH_JOURNAL_FILE, None to use the
+# batch library directly), and removed from the batch library in the background, with retries and an
+# exponential backoff (in seconds). After BATCH_JOURNAL_SYNC_ALERT failed attempts to remove an article
+# (over several posts), this is reported on Slack.
+BATCH_JOURNAL_SYNC_RETRIES = 3
+BATCH_JOURNAL_SYNC_BACKOFF = 2
+BATCH_JOURNAL_SYNC_ALERT = 8
+# Post to this URL instead of Twitter (e.g. the sink of the local stand-in, see stand_in.py)
+TWITTER_SINK_URL = None
+# Settings of the local stand-in for the external services: the port, the number of documents in the
+# synthetic corpus and in the library of posted articles, the median latency (seconds) and the spread
+# of its lognormal distribution, and the fraction of requests that fail
+STAND_IN_PORT = 5001
+STAND_IN_SEED = 42
+STAND_IN_CORPUS_SIZE = 5000
+STAND_IN_POSTED = 500
+STAND_IN_LATENCY = 0.0
+STAND_IN_LATENCY_SIGMA = 0.5
+STAND_IN_ERROR_RATE = 0.0
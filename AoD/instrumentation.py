@@ -0,0 +1,94 @@
+'''
+Lightweight instrumentation of the stages of a run: wall time, CPU time, growth of the peak
+resident memory and item counts
+'''
+import sys
+import time
+from contextlib import contextmanager
+
+import local_files
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def _peak_rss():
+    '''
+    The peak resident set size of this process, in bytes (None if it cannot be determined)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+class StageTimer(object):
+    """Collects the measurements for the consecutive stages of a run"""
+
+    def __init__(self):
+        """Constructor"""
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the code block as the stage 'name'. The record of the stage is yielded, so that
+        item counts can be added to record['counts']. Since the peak memory of a process never
+        decreases, the growth of the peak shows how much extra memory a stage needed."""
+        record = {'stage': name, 'counts': {}}
+        self.stages.append(record)
+        rss = _peak_rss()
+        cpu = time.process_time()
+        wall = time.time()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.time() - wall
+            record['cpu'] = time.process_time() - cpu
+            if rss is not None:
+                record['peak_rss_delta'] = _peak_rss() - rss
+
+    def summary(self):
+        """A human readable summary, one line per stage"""
+        lines = []
+        for record in self.stages:
+            line = "%-16s %8.2fs wall %8.2fs cpu" % (record['stage'], record.get('wall', 0), record.get('cpu', 0))
+            if 'peak_rss_delta' in record:
+                line += " %+8.1f MB" % (record['peak_rss_delta'] / 1e6)
+            if record['counts']:
+                line += "  " + ", ".join("%s=%s" % (k, v) for k, v in record['counts'].items())
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_prometheus(self, prefix='aod'):
+        """The measurements in the Prometheus text exposition format"""
+        metrics = [
+            ('stage_wall_seconds', 'wall', 'Wall time of the stage'),
+            ('stage_cpu_seconds', 'cpu', 'CPU time of the stage'),
+            ('stage_peak_rss_delta_bytes', 'peak_rss_delta', 'Growth of the peak resident memory during the stage'),
+        ]
+        lines = []
+        for metric, key, description in metrics:
+            lines.append('# HELP %s_%s %s' % (prefix, metric, description))
+            lines.append('# TYPE %s_%s gauge' % (prefix, metric))
+            for record in self.stages:
+                if key in record:
+                    lines.append('%s_%s{stage="%s"} %s' % (prefix, metric, record['stage'], record[key]))
+        lines.append('# HELP %s_stage_items Number of items processed in the stage' % prefix)
+        lines.append('# TYPE %s_stage_items gauge' % prefix)
+        for record in self.stages:
+            for item, value in record['counts'].items():
+                if isinstance(value, str):
+                    continue
+                lines.append('%s_stage_items{stage="%s",item="%s"} %s' % (prefix, record['stage'], item, float(value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, format='json'):
+        """Write the measurements to a file, either as JSON or as a Prometheus textfile. The file
+        is replaced atomically, so that a collector never reads a partial file."""
+        if format == 'prometheus':
+            with local_files.AtomicFile(path) as f:
+                f.write(self.to_prometheus())
+        else:
+            local_files.write_json(path, {'timestamp': time.time(), 'stages': self.stages}, indent=2)
@@ -0,0 +1,74 @@
+'''
+Reading and writing the files in the local cache directory. A file is written to a temporary file
+next to it first, which then replaces the file atomically, so that an interrupted write does not
+leave a corrupt file behind and a reader never sees a partial file.
+'''
+import os
+import gzip
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _open(path, mode, compress=False, compresslevel=9):
+    '''
+    Open a file, compressed with gzip if 'compress' is true
+    '''
+    if compress:
+        return gzip.open(path, mode, compresslevel=compresslevel)
+    return open(path, mode)
+
+class AtomicFile(object):
+    """A file that is written to a temporary file first, which replaces the file at 'path' when it
+    is committed. Used as a context manager, it is committed at the end of the block, unless the
+    block raised an exception (in which case it is discarded). With 'compress', the file is
+    compressed with gzip."""
+
+    def __init__(self, path, mode='w', compress=False, compresslevel=9):
+        """Constructor"""
+        self.path = path
+        self.tmp_path = "%s.tmp" % path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = _open(self.tmp_path, mode, compress=compress, compresslevel=compresslevel)
+
+    def commit(self):
+        """Close the file and let it replace the file at 'path'"""
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        """Close the file and remove it, leaving the file at 'path' as it was"""
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+def read_json(path, default=None, compress=False):
+    '''
+    The data in a JSON file, or 'default' when the file does not exist or cannot be read
+    '''
+    if not path or not os.path.exists(path):
+        return default
+    try:
+        with _open(path, 'rt', compress=compress) as f:
+            return json.load(f)
+    except Exception:
+        logger.exception('Unable to read local file {0}'.format(path))
+        return default
+
+def write_json(path, data, compress=False, **kwargs):
+    '''
+    Store data in a JSON file, replacing the file atomically (keyword arguments go to json.dump)
+    '''
+    with AtomicFile(path, 'wt', compress=compress) as f:
+        json.dump(data, f, **kwargs)
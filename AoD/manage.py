@@ -1,24 +1,44 @@
 import os
 import sys
 import time
+from flask import current_app
 from flask_script import Manager, Command, Option
 from app import create_app
 from AoD import generate_batch
 from AoD import post_article
+from AoD import post_article_async
 from utils import post_to_slack
+from client import connection_stats
+from instrumentation import StageTimer
 
 app = create_app()
+
+def log_connection_stats():
+    # Report how many requests reused a pooled connection (and thereby avoided a handshake)
+    stats = connection_stats()
+    current_app.logger.info('HTTP connections: {requests} requests, {connections} connections opened, {reused} reused'.format(**stats))
+
 # instantiate the manager object
 manager = Manager(app)
 
 class GenerateBatch(Command):
 
-    def run(self, **kwargs):
+    option_list = (
+        Option('--resync', dest='resync', action='store_true', default=False,
+               help='Rebuild the local index of previously posted articles'),
+        Option('--from-snapshot', dest='snapshot', default=None,
+               help='Run offline, using the Solr data from this snapshot file'),
+    )
+
+    def run(self, resync=False, snapshot=None, **kwargs):
         with create_app().app_context():
-            resp = generate_batch()
+            timer = StageTimer()
+            resp = generate_batch(resync=resync, snapshot=snapshot, timer=timer)
             # If 'resp' has a key 'Slack' we have to send
-            # a message to Slack
-            if 'Slack' in resp:
+            # a message to Slack (but not when running offline)
+            if snapshot is not None:
+                current_app.logger.info('Offline run finished: {0}'.format(resp))
+            elif 'Slack' in resp:
                 error_message = {
                     'text': resp['Slack'],
                     'link_names': 1
@@ -27,12 +47,24 @@ class GenerateBatch(Command):
                     slack = post_to_slack(error_message)
                 except:
                     current_app.logger.exception("Failed to post to Slack")
+            log_connection_stats()
+            # Also when the run failed, the stages that did run are of interest
+            metrics_file = current_app.config.get('METRICS_FILE')
+            if metrics_file:
+                try:
+                    timer.write(metrics_file, format=current_app.config.get('METRICS_FORMAT'))
+                except:
+                    current_app.logger.exception("Failed to write metrics to {0}".format(metrics_file))
 
 class PostArticle(Command):
 
     def run(self, **kwargs):
+        start = time.time()
         with create_app().app_context():
-            resp = post_article()
+            if current_app.config.get('POST_ASYNC'):
+                resp = post_article_async()
+            else:
+                resp = post_article()
             # If 'resp' has a key 'Slack' we have to send
             # a message to Slack
             if 'Slack' in resp:
@@ -44,7 +76,9 @@ class PostArticle(Command):
                     slack = post_to_slack(error_message)
                 except:
                     current_app.logger.exception("Failed to post to Slack")
-                
+            log_connection_stats()
+            current_app.logger.info('Posting the Article of the Day took {0:.2f} seconds'.format(time.time() - start))
+
 
 manager.add_command('generate', GenerateBatch())
 manager.add_command('post', PostArticle())
@@ -0,0 +1,136 @@
+'''
+Columnar storage of the node information of the papers network. Instead of a dictionary per
+paper, every attribute is stored as a single array (numeric attributes as numeric arrays), which
+takes less memory per node and allows computations over all nodes at once.
+'''
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# The node attributes, in the order of the node information of a paper (see NodeStore.node)
+COLUMNS = ('bibcode', 'nodeWeight', 'citation_count', 'read_count', 'title', 'year', 'first_author',
+           'author_count', 'cite_read_boost')
+# The columns with numbers, the others hold Python objects
+NUMERIC_COLUMNS = frozenset(['nodeWeight', 'citation_count', 'read_count', 'author_count', 'cite_read_boost'])
+
+def _get_values(doc):
+    '''
+    The node attributes of a paper from its Solr data, with the same defaults as the Solr fields
+    '''
+    return (doc['bibcode'],
+            doc.get('citation_count', 1),
+            doc.get('citation_count', 0),
+            doc.get('read_count', 0),
+            doc.get('title', 'NA')[0],
+            doc.get('year', 'NA'),
+            doc.get('first_author', 'NA'),
+            doc.get('author_count', 1),
+            doc.get('cite_read_boost', 'NA'))
+
+def _to_float(value):
+    '''
+    A number as a float, NaN if it is missing or not a number
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+def _numeric_column(values):
+    '''
+    An array with numbers: integers if all values are integers, otherwise floats, with NaN for
+    the values that are missing or not a number
+    '''
+    column = numpy.array(values)
+    if column.dtype.kind in 'iuf' and len(column) > 0:
+        return column
+    return numpy.array([_to_float(v) for v in values], dtype=float)
+
+def _object_column(values):
+    '''
+    An array with Python objects (like strings)
+    '''
+    column = numpy.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+class NodeStoreBuilder(object):
+    """Collects the node information of papers, one column at a time, to fill a NodeStore"""
+
+    def __init__(self):
+        """Constructor"""
+        self.values = dict((name, []) for name in COLUMNS)
+
+    def add(self, doc):
+        """Add the node information of a paper, from its Solr data"""
+        for name, value in zip(COLUMNS, _get_values(doc)):
+            self.values[name].append(value)
+
+    def build(self):
+        """The store with the papers added, in the order in which they were added"""
+        columns = {}
+        for name in COLUMNS:
+            if name in NUMERIC_COLUMNS:
+                columns[name] = _numeric_column(self.values[name])
+            else:
+                columns[name] = _object_column(self.values[name])
+        return NodeStore(columns)
+
+class NodeStore(object):
+    """The node information of the papers in the network, by column, in node order"""
+
+    def __init__(self, columns):
+        """Constructor"""
+        self.columns = columns
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __len__(self):
+        return len(self.columns['bibcode'])
+
+    def take(self, index):
+        """The store for the nodes 'index' (an array or list of positions), in that order"""
+        index = numpy.asarray(index, dtype=int)
+        return NodeStore(dict((name, column[index]) for name, column in self.columns.items()))
+
+    def node(self, i):
+        """The node information of node i, as a dictionary"""
+        cite_read_boost = self.cite_read_boost[i].item()
+        if cite_read_boost != cite_read_boost:
+            cite_read_boost = 'NA'
+        return {'nodeName': self.bibcode[i],
+                'nodeWeight': self.nodeWeight[i].item(),
+                'citation_count': self.citation_count[i].item(),
+                'read_count': self.read_count[i].item(),
+                'title': self.title[i],
+                'year': self.year[i],
+                'first_author': self.first_author[i],
+                'author_count': self.author_count[i].item(),
+                'cite_read_boost': cite_read_boost
+               }
+
+    def weights(self, index=None):
+        """The weight of the nodes 'index' (all nodes by default), determined from the number of
+        citations, the 90-day reads and the number of authors: log10(1 + (citations + reads)/authors),
+        which closely resembles the "classic factor". Where this cannot be determined, the
+        cite_read_boost is used instead."""
+        if index is None:
+            index = slice(None)
+        citations = self.citation_count[index].astype(float)
+        reads = self.read_count[index].astype(float)
+        authors = numpy.maximum(self.author_count[index].astype(float), 1)
+        with numpy.errstate(all='ignore'):
+            weights = numpy.log10(1 + (citations + reads) / authors)
+        invalid = ~numpy.isfinite(weights)
+        if invalid.any():
+            bibcodes = self.bibcode[index][invalid]
+            logger.warning('Failed to calculate weight for {0} nodes (like {1}), switching to cite_read_boost'.format(
+                len(bibcodes), ", ".join(bibcodes[:5])))
+            weights[invalid] = self.cite_read_boost[index][invalid]
+        return weights
@@ -2,34 +2,45 @@
 import sys
 import os
 import time
+import logging
 import operator
 import histeq
+import instrumentation
+import clustering
+import node_store
+import local_files
 from numpy import mat
-from numpy import zeros
-from numpy import fill_diagonal
 from numpy import sqrt, ones, multiply, array
 import numpy
+from scipy import sparse
 
 import networkx as nx
-import community
 import math
-from networkx.readwrite import json_graph
 from collections import defaultdict
 
 import tf_idf
 
 __all__ = ['get_papersnetwork']
 
+logger = logging.getLogger(__name__)
+
 # Helper functions
 def _get_reference_mapping(data):
     '''
-    Construct the reference dictionary for a set of bibcodes
+    Construct the reference dictionary for a set of bibcodes, together with the node information
+    of the papers with references (a node_store.NodeStore, in the order of the data), in a single
+    pass over the data (which may be a generator of Solr documents). Also returns the total number
+    of papers in the data.
     '''
+    number_of_papers = 0
     refdict = {}
+    nodes = node_store.NodeStoreBuilder()
     for doc in data:
+        number_of_papers += 1
         if 'reference' in doc:
             refdict[doc['bibcode']] = set(doc['reference'])
-    return refdict
+            nodes.add(doc)
+    return number_of_papers, refdict, nodes.build()
 
 def _get_paper_data(data):
     '''
@@ -57,133 +68,398 @@ def _sort_and_cut_results(resdict,cutoff=1500):
             cutdict[index[0]] = index[1]
         return cutdict
 
+def _get_citation_matrix(papers, reference_dictionary, use_sparse=True):
+    '''
+    Construct the paper-citation occurence matrix R, in which every row corresponds with
+    a cited paper and every column with a paper in the 'papers' list. With 'use_sparse'
+    the matrix is built in CSR format, so that its size scales with the number of references
+    rather than with the number of papers times the number of unique references
+    '''
+    # Compile a unique list of cited papers
+    ref_list = list(set([ref for sublist in reference_dictionary.values() for ref in sublist]))
+    # transform that list into a dictionary for fast lookup
+    ref_list = dict(zip(ref_list, range(len(ref_list))))
+    if use_sparse:
+        rows = []
+        cols = []
+        for col, p in enumerate(papers):
+            ref_ind = [ref_list.get(a) for a in reference_dictionary[p]]
+            rows.extend(ref_ind)
+            cols.extend([col]*len(ref_ind))
+        data = ones(len(rows), dtype=int)
+        return sparse.csr_matrix((data, (rows, cols)), shape=(len(ref_list), len(papers)))
+    empty_vec = [0]*len(ref_list)
+    entries = []
+    for p in papers:
+        vec = empty_vec[:]
+        ref_ind = map(lambda a: ref_list.get(a), reference_dictionary[p])
+        for entry in ref_ind:
+            vec[entry] = 1
+        entries.append(vec)
+    return mat(entries).T
+
+def _get_cooccurrence_matrix(R, number_of_papers, weighted=True):
+    '''
+    Construct the co-occurence (paper-paper) matrix C from the paper-citation matrix R.
+    Without weights this is R_t*R, otherwise R_t*(R-W). Each row of the weight matrix W is
+    the corresponding row of R scaled by the fraction of all papers citing that reference,
+    so R-W is R with every row k scaled by (1 - n_k/N), with n_k the number of papers
+    citing reference k and N the number of papers. We apply that scaling directly, which
+    means that W itself is never constructed.
+    '''
+    if not weighted or R.shape[0] < 2:
+        return R.T*R
+    # The number of papers citing each reference, as a column vector
+    citing = array(R.sum(axis=1))
+    scaling = 1.0 - citing / float(number_of_papers)
+    if sparse.issparse(R):
+        return R.T*sparse.csr_matrix(R.multiply(scaling))
+    return R.T*multiply(R, scaling)
+
+def _upper_triangle(C):
+    '''
+    Return the row indices, column indices and values of the non-zero entries in the upper
+    triangle (diagonal excluded) of the co-occurence matrix C, in row-major order
+    '''
+    if sparse.issparse(C):
+        Cu = sparse.triu(C, k=1, format='csr')
+        Cu.eliminate_zeros()
+        Cu.sort_indices()
+        Cu = Cu.tocoo()
+        return Cu.row, Cu.col, Cu.data
+    Cu = numpy.triu(numpy.asarray(C), k=1)
+    rows, cols = Cu.nonzero()
+    return rows, cols, Cu[rows, cols]
+
+def _get_links(papers, reference_dictionary, C):
+    '''
+    Compile the links between papers from the co-occurence matrix C. The force of a link
+    is the co-occurence scaled by the inverse square root of the product of the number of
+    references of the linked papers (the outer product of the reference counts, evaluated
+    at the non-zero entries of C). Returns arrays with the sources, targets and (rounded)
+    forces of the links in the upper triangle of C, with a positive force.
+    '''
+    rows, cols, values = _upper_triangle(C)
+    ref_counts = array([len(reference_dictionary[p]) for p in papers], dtype=int)
+    scale = sqrt(ref_counts[rows]*ref_counts[cols])
+    force = 100*values / scale
+    positive = force > 0
+    force = numpy.rint(force[positive]).astype(int)
+    return rows[positive], cols[positive], force
+
+def _get_link_dictionary(papers, source, target, force):
+    '''
+    Transform the link arrays into a dictionary with tab-joined bibcode pairs as keys and
+    forces as values, containing both directions of each link
+    '''
+    link_dict = {}
+    for i, j, value in zip(source.tolist(), target.tolist(), force.tolist()):
+        link_dict["%s\t%s"%(papers[i],papers[j])] = value
+        link_dict["%s\t%s"%(papers[j],papers[i])] = value
+    return link_dict
+
+def _get_link_arrays(papers, link_dict):
+    '''
+    Transform a dictionary of links (see _get_link_dictionary) back into the link arrays, with
+    every link once (source < target), in row-major order
+    '''
+    position = dict(zip(papers, range(len(papers))))
+    pairs = {}
+    for link, value in link_dict.items():
+        paper1, paper2 = link.split('\t')
+        i, j = position[paper1], position[paper2]
+        pairs[(min(i, j), max(i, j))] = value
+    links = sorted(pairs)
+    source = array([link[0] for link in links], dtype=int)
+    target = array([link[1] for link in links], dtype=int)
+    force = array([pairs[link] for link in links])
+    return source, target, force
+
+def _index_groups(group, source, target):
+    '''
+    Index the network by group, in a single sweep over the nodes and a single sweep over
+    the links, given the group of every node and the link arrays. Returns a dictionary with
+    the member nodes of every group and a dictionary with the links within every group.
+    '''
+    group_members = defaultdict(list)
+    for paper, g in enumerate(group.tolist()):
+        group_members[g].append(paper)
+    group_edges = defaultdict(list)
+    internal = group[source] == group[target]
+    for paper_one, paper_two, g in zip(source[internal].tolist(), target[internal].tolist(), group[source[internal]].tolist()):
+        group_edges[g].append((paper_one, paper_two))
+    return group_members, group_edges
+
+def _get_common_references(edges, reference_sets, num_papers, max_references=5):
+    '''
+    Find the most common co-references among the papers in a group, given the edges within
+    that group. The reference overlap is only needed for these intra-group connections, so we
+    determine it here. Returns a dictionary with the fraction of papers in the group that share
+    each of the top 'max_references' co-references.
+    '''
+    references = defaultdict(set)
+    for paper_one, paper_two in edges:
+        for bib in reference_sets[paper_one].intersection(reference_sets[paper_two]):
+            references[bib].update([paper_one, paper_two])
+    count_references = sorted(references.items(), key=lambda x:len(x[1]), reverse = True)[:max_references]
+    top_common_references = [(tup[0], float("{0:.2f}".format(len(tup[1])/num_papers))) for tup in count_references]
+    return dict(top_common_references)
+
+class PaperNetwork(object):
+    """The papers network as compact arrays: the node information of every paper (a
+    node_store.NodeStore, in node order), the links as arrays of sources, targets and forces (every link once, with source < target) and,
+    once it has been clustered (see augment_graph_data), the group of every node together with the
+    summary of the top groups. The node-link data for d3 is only produced on request (to_node_link)."""
+
+    def __init__(self, nodes, source, target, force):
+        """Constructor"""
+        self.nodes = nodes
+        self.source = source
+        self.target = target
+        self.force = force
+        # The group of every node and the summary of the top groups, by group
+        self.group = None
+        self.groups = {}
+
+    def names(self):
+        """The bibcodes of the papers, in node order"""
+        return self.nodes.bibcode.tolist()
+
+    def graph(self, positive=False):
+        """The networkx graph of the network, with the nodes numbered in node order and the forces
+        as link weights (the node information is not copied into the graph). With 'positive', the
+        links with a force of zero are left out."""
+        source, target, force = self.source, self.target, self.force
+        if positive:
+            keep = force > 0
+            source, target, force = source[keep], target[keep], force[keep]
+        G = nx.Graph()
+        G.add_nodes_from(range(len(self.nodes)))
+        G.add_weighted_edges_from(zip(source.tolist(), target.tolist(), force.tolist()))
+        return G
+
+    def adjacency(self):
+        """The weighted adjacency matrix of the network (a symmetric scipy.sparse CSR matrix, in
+        node order), built directly from the link arrays"""
+        n = len(self.nodes)
+        rows = numpy.concatenate([self.source, self.target])
+        cols = numpy.concatenate([self.target, self.source])
+        values = numpy.concatenate([self.force, self.force]).astype(float)
+        return sparse.csr_matrix((values, (rows, cols)), shape=(n, n))
+
+    def members(self):
+        """The nodes in the top groups (in node order) and their groups, as arrays"""
+        if self.group is None:
+            return array([], dtype=int), array([], dtype=int)
+        index = numpy.nonzero(numpy.in1d(self.group, list(self.groups)))[0]
+        return index, self.group[index]
+
+    def to_node_link(self):
+        """The node-link data of the network for d3: the summary graph of the top groups
+        ("summaryGraph") and the papers in these groups ("fullGraph"). A network that has
+        not been clustered only has the "fullGraph", with all papers and links."""
+        if self.group is None:
+            links = []
+            for i, j, value in zip(self.source.tolist(), self.target.tolist(), self.force.tolist()):
+                links.append({'source':i, 'target':j, 'value':value})
+                links.append({'source':j, 'target':i, 'value':value})
+            return {"fullGraph": {'nodes': [self.nodes.node(i) for i in range(len(self.nodes))], 'links': links}}
+        group = self.group
+        index = self.members()[0]
+        kept = numpy.zeros(len(self.nodes), dtype=bool)
+        kept[index] = True
+        nodes = []
+        for i in index.tolist():
+            x = self.nodes.node(i)
+            nodes.append({'node_name': x["nodeName"], 'nodeWeight': x["nodeWeight"], 'title': x["title"],
+                          'citation_count': x["citation_count"], 'first_author': x["first_author"],
+                          'read_count': x["read_count"], 'cite_read_boost': x["cite_read_boost"],
+                          'author_count': x["author_count"], 'group': group[i].item(), 'id': i})
+        both = kept[self.source] & kept[self.target]
+        links = [{'weight': value, 'source': i, 'target': j} for i, j, value in
+                 zip(self.source[both].tolist(), self.target[both].tolist(), self.force[both].tolist())]
+        # The links of the summary graph are the total forces of the links between (and within) groups
+        position = dict((g, index) for index, g in enumerate(self.groups))
+        summary_links = defaultdict(int)
+        for i, j, value in zip(group[self.source[both]].tolist(), group[self.target[both]].tolist(),
+                               self.force[both].tolist()):
+            if position[i] > position[j]:
+                i, j = j, i
+            summary_links[(i, j)] += value
+        summary_json = _node_link([dict(summary, id=g) for g, summary in self.groups.items()],
+                                  [{'weight': summary_links[link], 'source': link[0], 'target': link[1]}
+                                   for link in sorted(summary_links, key=lambda l: (position[l[0]], position[l[1]]))])
+        return {"summaryGraph": summary_json, "fullGraph": _node_link(nodes, links)}
+
+def _node_link(nodes, links):
+    '''
+    Node-link data of an undirected graph, in the format of networkx.readwrite.json_graph
+    '''
+    return {'directed': False, 'multigraph': False, 'graph': {}, 'nodes': nodes, 'links': links}
+
 #Alex's function that takes a generated graph and gives you back a graph with groups
 
-def augment_graph_data(data, max_groups):
+def _best_partition(network, partition_file=None, min_overlap=0.5, compare_cold=False, stats=None,
+                    backend='python-louvain', seed=None):
+    '''
+    Find the communities in the network (a PaperNetwork) with the specified clustering backend (see
+    clustering.py). The Louvain backend gets the networkx graph of the network, the other backends
+    its sparse adjacency matrix. If the backend supports it (like Louvain), the partition of the
+    previous run is stored in 'partition_file' and at least a fraction 'min_overlap' of the nodes
+    was part of it, the clustering starts from that partition instead of from every node in its own community (papers
+    that are new get a community of their own). This converges faster and keeps the communities
+    stable from one run to the next. The partition found is stored for the next run. With
+    'compare_cold', a cold start is timed as well. The timings are added to 'stats', if specified.
+    '''
+    if stats is None:
+        stats = {}
+    stats['backend'] = backend
+    names = network.names()
+    number_of_nodes = len(names)
+    previous = {}
+    if backend in clustering.WARM_START_BACKENDS:
+        previous = local_files.read_json(partition_file, {})
+    initial = None
+    if len(previous) > 0 and number_of_nodes > 0:
+        known = [n for n in range(number_of_nodes) if names[n] in previous]
+        stats['partition_overlap'] = round(len(known) / float(number_of_nodes), 3)
+        if len(known) >= min_overlap * number_of_nodes:
+            initial = dict((n, previous[names[n]]) for n in known)
+            new_community = max(previous.values()) + 1
+            for n in range(number_of_nodes):
+                if n not in initial:
+                    initial[n] = new_community
+                    new_community += 1
+    stats['warm_start'] = initial is not None
+    # Only the backends that need it get a networkx graph, the others work on the link arrays
+    # (as a sparse matrix)
+    if initial is not None:
+        # Links with a force that was rounded to zero do not contribute to the modularity, but
+        # python-louvain refuses them when it starts from a given partition
+        data = network.graph(positive=True)
+    elif clustering.uses_graph(backend):
+        data = network.graph()
+    else:
+        data = network.adjacency()
+    start = time.time()
+    partition = clustering.get_partition(data, backend=backend, seed=seed, partition=initial)
+    stats['partition_seconds'] = round(time.time() - start, 3)
+    if compare_cold and initial is not None:
+        start = time.time()
+        clustering.get_partition(data, backend=backend, seed=seed)
+        stats['partition_cold_seconds'] = round(time.time() - start, 3)
+        logger.info('Clustering took {0}s from the previous partition, {1}s from a cold start'.format(
+            stats['partition_seconds'], stats['partition_cold_seconds']))
+    if partition_file is not None:
+        try:
+            local_files.write_json(partition_file, dict((names[n], c) for n, c in partition.items()))
+        except Exception:
+            logger.exception('Unable to store partition in {0}'.format(partition_file))
+    return partition
+
+def augment_graph_data(network, max_groups, reference_sets=None, partition_file=None, compare_cold=False, stats=None,
+                       backend='python-louvain', seed=None):
+    '''
+    Cluster the paper network (a PaperNetwork) and summarize the clusters. The group of every node
+    and the summary of the top 'max_groups' clusters are stored in the network, which is returned.
+    The (optional) 'reference_sets' contains the set of references for each node, in node order, and
+    is used to find the most common co-references within each cluster. The reference overlap of two
+    papers is only determined for the links within the top clusters.
+    The clustering starts from the partition of the previous run, if it is stored in the
+    'partition_file' (see _best_partition). The communities are found with the clustering 'backend',
+    using the specified 'seed'.
+    '''
 
-    total_nodes = len(data['nodes'])
+    total_nodes = len(network.nodes)
 
     #lowering the necessary node count
     #since in some cases node count is greatly reduced after processing
     # first author kurtz,m goes from ~60 to 19 for instance
 
     if total_nodes < 15:
-        #just get rid of the sets
-        for i, l in enumerate(data["links"]):
-            data["links"][i]["overlap"] = list(l["overlap"])
-
-        return {"fullGraph" :data}
-
-    #create the networkx graph
-    G = nx.Graph()
-    for i,x in enumerate(data['nodes']):
-        G.add_node(i, node_name= x["nodeName"], nodeWeight = x["nodeWeight"], title=x["title"], citation_count=x["citation_count"], first_author = x["first_author"], read_count = x["read_count"], cite_read_boost = x["cite_read_boost"], author_count = x["author_count"])
-
-    for i,x in enumerate(data['links']):
-        G.add_edge(x["source"], x["target"], weight = x["value"], overlap = list(x["overlap"]))
-
-    all_nodes = G.nodes()
+        return network
 
     #partition is a dictionary with group names as keys
     # and individual node indexes as values
-    partition = community.best_partition(G)
+    partition = _best_partition(network, partition_file=partition_file, compare_cold=compare_cold,
+                                stats=stats, backend=backend, seed=seed)
 
-    for g in G.nodes():
-        G.node[g]["group"] = partition[g]
+    group = array([partition[paper] for paper in range(total_nodes)], dtype=int)
 
-    #with new group info, create the summary group graph
-    summary_graph = community.induced_graph(partition, G)
+    #the groups, in the order in which they occur in the partition
+    groups = dict((g, {}) for g in partition.values())
 
     #title container
     titles = {}
 
+    #index the members and the intra-group links of every group in a single sweep
+    group_members, group_edges = _index_groups(group, network.source, network.target)
+
     #enhance the information that will be in the json handed off to d3
-    for x in summary_graph.nodes():
-        summary_graph.node[x]["total_citations"] = sum([G.node[paper].get("citation_count", 0) for paper in G.nodes() if G.node[paper]["group"] == x])
-        summary_graph.node[x]["total_reads"] = sum([G.node[paper].get("read_count", 0) for paper in G.nodes() if G.node[paper]["group"] == x])
-        papers = sorted([G.node[paper] for paper in G.nodes() if G.node[paper]["group"] == x], key = lambda x: x.get("nodeWeight", 0), reverse = True)
-        titles[x] = [p["title"]for p in papers]
-        summary_graph.node[x]["paper_count"] = len(papers)
-
-    #attaching title 'word clouds' to the nodes
+    nodes = network.nodes
+    for x in groups:
+        papers = array(group_members[x], dtype=int)
+        groups[x]["total_citations"] = nodes.citation_count[papers].sum().item()
+        groups[x]["total_reads"] = nodes.read_count[papers].sum().item()
+        #the titles by decreasing node weight (in node order for equal weights)
+        papers = papers[numpy.argsort(-nodes.nodeWeight[papers], kind='stable')]
+        titles[x] = nodes.title[papers].tolist()
+        groups[x]["paper_count"] = len(papers)
+
+    #attaching title 'word clouds' to the groups
     significant_words = tf_idf.get_tf_idf_vals(titles)
-    for x in list(summary_graph.nodes()):
+    for x in list(groups):
         #remove the ones with only 1 paper
-        if summary_graph.node[x]["paper_count"] == 1:
-            summary_graph.remove_node(x)
+        if groups[x]["paper_count"] == 1:
+            del groups[x]
         else:
             #otherwise, give them a title
             #how many words should we show on the group? max 6, otherwise 1 per every 2 papers
-            summary_graph.node[x]["node_label"] =  dict(sorted(significant_words[x].items(), key = lambda x: x[1], reverse = True)[:6])
+            groups[x]["node_label"] =  dict(sorted(significant_words[x].items(), key = lambda x: x[1], reverse = True)[:6])
 
-
-    #remove all but top n groups from summary graph
+    #keep the top n groups only
     #where top n is measured by total citations from a group
-    top_nodes = list(sorted([n for n in summary_graph.nodes(data = True)], key= lambda x : x[1]["total_citations"], reverse = True ))[:max_groups]
-#    top_nodes = [t for t in top_nodes if t >=1]
-    top_node_ids = [n[0] for n in top_nodes]
-    for group_id in list(summary_graph.nodes()):
-        if group_id not in top_node_ids:
-            summary_graph.remove_node(group_id)
-
-    #remove nodes from full graph that aren't in top group
-    #this automatically takes care of edges, too
-    for node in list(G.nodes(data = True)):
-        if node[1]["group"] not in top_node_ids:
-            G.remove_node(node[0])
+    top_node_ids = set(sorted(groups, key=lambda x: groups[x]["total_citations"], reverse=True)[:max_groups])
+    groups = dict((x, summary) for x, summary in groups.items() if x in top_node_ids)
 
     #continuing to enhance the information: add to group info about the most common co-references
-    for x in summary_graph.nodes():
+    for x in groups:
         #make a float so division later to get a percent makes sense
-        num_papers =  float(summary_graph.node[x]["paper_count"])
-        references = {}
-        #find all members of group x
-        indexes =  [paperIndex for paperIndex in G.nodes() if G.node[paperIndex]["group"] == x]
-        for edge in G.edges(data=True):
-            #if it passes, it's an inter-group connection
-            # [0] is source, [1] is target, [2] is data dict
-            paper_one = edge[0]
-            paper_two = edge[1]
-            if paper_one in indexes and paper_two in indexes:
-                for bib in edge[2]["overlap"]:
-                    if bib in references:
-                        references[bib].update([paper_one, paper_two])
-                    else:
-                        references[bib] = set([paper_one, paper_two])
-
-        count_references = sorted(references.items(), key=lambda x:len(x[1]), reverse = True)[:5]
-        top_common_references = [(tup[0], float("{0:.2f}".format(len(tup[1])/num_papers))) for tup in count_references]
-        top_common_references = dict(top_common_references)
-        summary_graph.node[x]["top_common_references"] = top_common_references
-
-    summary_json = json_graph.node_link_data(summary_graph)
+        num_papers =  float(groups[x]["paper_count"])
+        top_common_references = {}
+        if reference_sets is not None:
+            top_common_references = _get_common_references(group_edges[x], reference_sets, num_papers)
+        groups[x]["top_common_references"] = top_common_references
 
     # giving groups node_names based on size of groups
-    for i, n in enumerate(sorted(summary_json["nodes"], key=lambda x:x["paper_count"], reverse=True)):
-        for possible_real_index, node in enumerate(summary_json["nodes"]):
-            if node == n:
-                real_index = possible_real_index
-        summary_json["nodes"][real_index]["node_name"] = i +1
-
+    for i, x in enumerate(sorted(groups, key=lambda x: groups[x]["paper_count"], reverse=True)):
+        groups[x]["node_name"] = i + 1
 
-    for i, n in enumerate(summary_json["nodes"]):
+    for i, x in enumerate(groups):
         #cache this so graph manipulation later is easier
-        summary_json["nodes"][i]["stable_index"] = i
-        #find the node
-
-    final_data = {"summaryGraph" : summary_json, "fullGraph" : json_graph.node_link_data(G) }
-    return final_data
+        groups[x]["stable_index"] = i
 
+    network.group = group
+    network.groups = groups
+    return network
 
 
 # Main machinery
-def get_papernetwork(solr_data, max_groups, weighted=True, equalization=False, do_cutoff=False):
+def get_clustered_network(solr_data, max_groups, weighted=True, equalization=False, do_cutoff=False, use_sparse=True,
+                          timer=None, partition_file=None, compare_cold=False,
+                          clustering_backend='python-louvain', clustering_seed=None):
     '''
-    Given a list of bibcodes, this function builds the papers network based on co-citations
+    Given a list (or generator) of Solr documents, this function builds the papers network based on co-citations
+    and clusters it. The network is returned as a PaperNetwork (see get_papernetwork for its node-link data).
     If 'weighted' is true, we will normalize the co-occurence frequency with the total number
     of papers in the set, otherwise we will work with the actual co-occurence frequencies.
     If 'equalization' is true, histogram equalization will be applied to the force values in
-    the network
+    the network. If 'use_sparse' is true the matrices below are stored in sparse format, otherwise
+    dense matrices are used. The construction of the network and its clustering are recorded as
+    separate stages by the 'timer' (an instrumentation.StageTimer), if specified. The clustering is
+    warm-started from the partition stored in 'partition_file' by the previous run (if any); with
+    'compare_cold' a cold start is timed as well. The 'clustering_backend' and 'clustering_seed'
+    select the clustering method (see clustering.py).
 
     Approach: given a reference dictionary {'paper1':['a','b','c',...], 'paper2':['b','c','g',...], ...}
               we contruct a matrix [[0,1,0,1,...], [0,0,1,...], ...] where every row corresponds with
@@ -194,29 +470,47 @@ def get_papernetwork(solr_data, max_groups, weighted=True, equalization=False, d
               the force between nodes with a factor proportional to the inverse square root of the product
               of the number of references in the linked nodes.
     '''
-    # Get get paper list from the Solr data
-    papers_list = [e['bibcode'] for e in solr_data]
-    number_of_papers = len(papers_list)
-    # First construct the reference dictionary, and a unique list of cited papers
-    reference_dictionary = _get_reference_mapping(solr_data)
+    if timer is None:
+        timer = instrumentation.StageTimer()
+    with timer.stage('network') as stage:
+        network, reference_sets = _build_network(solr_data, weighted=weighted, equalization=equalization,
+                                                 do_cutoff=do_cutoff, use_sparse=use_sparse,
+                                                 stats=stage['counts'])
+    with timer.stage('clustering') as stage:
+        augment_graph_data(network, max_groups, reference_sets=reference_sets,
+                           partition_file=partition_file, compare_cold=compare_cold, stats=stage['counts'],
+                           backend=clustering_backend, seed=clustering_seed)
+        stage['counts']['clusters'] = len(network.groups)
+    return network
+
+def get_papernetwork(solr_data, max_groups, weighted=True, equalization=False, do_cutoff=False, use_sparse=True,
+                     timer=None, partition_file=None, compare_cold=False,
+                     clustering_backend='python-louvain', clustering_seed=None):
+    '''
+    The node-link data (for d3) of the clustered papers network for a list (or generator) of Solr
+    documents: the summary graph of the clusters in "summaryGraph" and the papers in these clusters in
+    "fullGraph". See get_clustered_network for the options.
+    '''
+    network = get_clustered_network(solr_data, max_groups, weighted=weighted, equalization=equalization,
+                                    do_cutoff=do_cutoff, use_sparse=use_sparse,
+                                    timer=timer, partition_file=partition_file, compare_cold=compare_cold,
+                                    clustering_backend=clustering_backend, clustering_seed=clustering_seed)
+    return network.to_node_link()
+
+def _build_network(solr_data, weighted=True, equalization=False, do_cutoff=False, use_sparse=True,
+                   stats=None):
+    '''
+    Build the nodes and links of the papers network (see get_clustered_network), before clustering.
+    Returns the network (a PaperNetwork) together with the set of references for each node, in node order.
+    If a 'stats' dictionary is specified, the sizes of the data and the network are added to it.
+    '''
+    # First construct the reference dictionary. The Solr data is only consumed once, so it
+    # can also be a generator of documents
+    number_of_papers, reference_dictionary, nodes = _get_reference_mapping(solr_data)
     # From now on we'll only work with publications that actually have references
     papers = list(reference_dictionary.keys())
-    # Compile a unique list of cited papers
-    ref_list = list(set([ref for sublist in reference_dictionary.values() for ref in sublist]))
-    # transform that list into a dictionary for fast lookup
-    ref_list = dict(zip(ref_list, range(len(ref_list))))
-    empty_vec = [0]*len(ref_list)
     # Construct the paper-citation occurence matrix R
-    entries = []
-    for p in papers:
-        vec = empty_vec[:]
-        ref_ind = map(lambda a: ref_list.get(a), reference_dictionary[p])
-        for entry in ref_ind:
-            vec[entry] = 1
-        entries.append(vec)
-    #done with ref_list
-    ref_list = None
-    R = mat(entries).T
+    R = _get_citation_matrix(papers, reference_dictionary, use_sparse=use_sparse)
     # Contruct the weights matrix, in case we are working with normalized strengths
     # If the weight matrix seems uniform, it is coincidental. For example, do an author
     # query for "Henneken, E" and print out W.torows() or, later, C.torows().
@@ -224,75 +518,40 @@ def get_papernetwork(solr_data, max_groups, weighted=True, equalization=False, d
     # dense networks, but for sparser networks it causes this distribution to be more
     # sparse. Normalization has no noticable influence no performance, based on testing
     # with J. Huchra as author.
-    if weighted:
-        lpl = float(len(papers_list))
-        weights = []
-        for row in R:
-            weights.append(array(row) * ((row * row.T / lpl).item()))
-        if (len(weights) < 2):
-            W = zeros(shape=R.shape)
-        else:
-            W = numpy.concatenate(weights)
-        # Done with weights
-        del weights
-        # Get the co-occurence matrix C
-        C = R.T*(R-W)
-    else:
-        C = R.T*R
+    C = _get_cooccurrence_matrix(R, number_of_papers, weighted=weighted)
     # Done with R
     del R
-    # In practice we don't need to fill the diagonal with zeros, because we won't be using it
-    fill_diagonal(C, 0)
-    # Compile the list of links
-    links = []
-    link_dict = {}
-    # Can this be done faster? It looks like this could be done via matrix multiplication
     # Don't forget that this is a symmetrical relationship and the diagonal is irrelevant,
-    # so we will only iterate over the upper diagonal. Seems like this could be pulled in
-    # the generation of W (above)
-    ref_papers = dict(zip(papers, range(len(papers))))
-    Npapers = len(papers)
-    for i in range(Npapers):
-        for j in range(i+1,Npapers):
-            scale = sqrt(len(list(reference_dictionary[papers[i]]))*len(list(reference_dictionary[papers[j]])))
-            force = 100*C[ref_papers.get(papers[i]),ref_papers.get(papers[j])] / scale
-            if force > 0:
-                link_dict["%s\t%s"%(papers[i],papers[j])] = int(round(force))
-                link_dict["%s\t%s"%(papers[j],papers[i])] = int(round(force))
-    # Cut the list of links to the maximum allowed by first sorting by force strength and then cutting by maximum allowed
-    if do_cutoff:
-        link_dict = _sort_and_cut_results(link_dict)
-    # If histogram equalization was selected, do this and replace the links list
-    if equalization:
-        links = []
-        HE = histeq.HistEq(link_dict)
-        link_dict = HE.hist_eq()
-    # Now contruct the list of links
-    for link in link_dict:
-        paper1,paper2 = link.split('\t')
-        overlap = reference_dictionary[paper1].intersection(reference_dictionary[paper2])
-        force = link_dict[link]
-        links.append({'source':ref_papers.get(paper1), 'target': ref_papers.get(paper2), 'value':force, 'overlap':overlap})
+    # so we will only work with the non-zero entries in the upper diagonal.
+    source, target, force = _get_links(papers, reference_dictionary, C)
+    # Done with C
+    del C
+    if do_cutoff or equalization:
+        # Both the cutoff and the equalization work on the dictionary of links
+        link_dict = _get_link_dictionary(papers, source, target, force)
+        # Cut the list of links to the maximum allowed by first sorting by force strength and then cutting by maximum allowed
+        if do_cutoff:
+            link_dict = _sort_and_cut_results(link_dict)
+        # If histogram equalization was selected, do this and replace the links
+        if equalization:
+            HE = histeq.HistEq(link_dict)
+            link_dict = HE.hist_eq()
+        # Now transform the links back into arrays
+        source, target, force = _get_link_arrays(papers, link_dict)
+        del link_dict
     # Compile node information
-    selected_papers = {}.fromkeys(papers)
     #because the nodes must be inserted at the proper index
-    nodes = [None]*len(ref_papers)
-    for paper in solr_data:
-        if paper['bibcode'] not in selected_papers:
-            continue
-        index = ref_papers[paper["bibcode"]]
-        nodes[index] ={'nodeName':paper['bibcode'],
-                        'nodeWeight':paper.get('citation_count',1),
-                        'citation_count':paper.get('citation_count',0),
-                        'read_count':paper.get('read_count',0),
-                        'title':paper.get('title','NA')[0],
-                        'year':paper.get('year','NA'),
-                        'first_author':paper.get('first_author','NA'),
-                        'author_count':paper.get('author_count',1),
-                        'cite_read_boost': paper.get('cite_read_boost','NA')
-                  }
+    position = dict(zip(nodes.bibcode.tolist(), range(len(nodes))))
+    nodes = nodes.take([position[p] for p in papers])
     # That's all folks!
-    paper_network = {'nodes': nodes, 'links': links}
+    network = PaperNetwork(nodes, source, target, force)
 
     # not quite all...
-    return augment_graph_data(paper_network, max_groups)
+    # The reference overlap between linked papers is determined later on, and only when needed
+    reference_sets = [reference_dictionary[p] for p in papers]
+    if stats is not None:
+        stats['documents'] = number_of_papers
+        stats['papers'] = len(papers)
+        stats['references'] = len(set().union(*reference_sets))
+        stats['links'] = len(force)
+    return network, reference_sets
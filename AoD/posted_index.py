@@ -0,0 +1,60 @@
+'''
+Local index of the articles that were posted earlier as ADS Article of the Day
+'''
+import os
+import time
+import sqlite3
+
+class PostedIndex(object):
+    """Persistent index of posted bibcodes, kept in sync with the library holding all posted articles.
+    The number of records in that library at the time of the last sync is stored as the watermark,
+    so that a sync only needs to retrieve the records added after that."""
+
+    def __init__(self, path):
+        """Constructor"""
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS posted (bibcode TEXT PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sync (key TEXT PRIMARY KEY, value REAL)")
+        self.conn.commit()
+
+    def __get_sync_value(self, key):
+        """Get a value from the sync metadata (zero if it was never set)"""
+        row = self.conn.execute("SELECT value FROM sync WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def watermark(self):
+        """The number of records in the library at the time of the last sync"""
+        return int(self.__get_sync_value('watermark'))
+
+    def last_full_sync(self):
+        """The time of the last full sync"""
+        return self.__get_sync_value('full_sync')
+
+    def size(self):
+        """The number of bibcodes in the index"""
+        return self.conn.execute("SELECT COUNT(*) FROM posted").fetchone()[0]
+
+    def add(self, bibcodes, watermark):
+        """Add the bibcodes of newly retrieved records and update the watermark"""
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO posted (bibcode) VALUES (?)", [(b,) for b in bibcodes])
+            self.conn.execute("INSERT OR REPLACE INTO sync (key, value) VALUES ('watermark', ?)", (watermark,))
+
+    def reset(self):
+        """Empty the index, so that the next sync is a full one"""
+        with self.conn:
+            self.conn.execute("DELETE FROM posted")
+            self.conn.execute("INSERT OR REPLACE INTO sync (key, value) VALUES ('watermark', 0)")
+            self.conn.execute("INSERT OR REPLACE INTO sync (key, value) VALUES ('full_sync', ?)", (time.time(),))
+
+    def bibcodes(self):
+        """All bibcodes in the index, as a set for constant time membership tests"""
+        return frozenset(row[0] for row in self.conn.execute("SELECT bibcode FROM posted"))
+
+    def close(self):
+        self.conn.close()
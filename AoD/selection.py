@@ -0,0 +1,103 @@
+'''
+Selection of the candidates for the Article of the Day from the clusters of the paper network.
+For every cluster, a bounded heap keeps the papers with the largest weights. The batches are
+chosen by walking the papers ranked this way, at most one paper per cluster per batch, so that the
+papers in a batch do not share a journal (bibstem) or first author (see SELECTION_DIVERSITY in
+config.py).
+'''
+import heapq
+import random
+from collections import namedtuple
+
+# A candidate paper, with the attributes used for the diversity of a batch
+Candidate = namedtuple('Candidate', ['bibcode', 'first_author'])
+
+def _bibstem(candidate):
+    return candidate.bibcode[4:9]
+
+def _first_author(candidate):
+    author = (candidate.first_author or '').strip().lower()
+    # An unknown first author does not clash with anything
+    if author in ('', 'na'):
+        return None
+    return author
+
+# The attributes that can be required to differ between the papers in a batch
+DIVERSITY_ATTRIBUTES = {
+    'bibstem': _bibstem,
+    'first_author': _first_author,
+}
+# The attributes that differ between the papers in a batch by default (SELECTION_DIVERSITY in config.py)
+DEFAULT_DIVERSITY = ('bibstem', 'first_author')
+
+def top_papers(papers, clusters, weights, k=10):
+    '''
+    The (at most) k papers with the largest weights in every cluster, by decreasing weight (in
+    the order of 'papers' for equal weights). 'clusters' and 'weights' contain the cluster and
+    the weight of every paper. Every cluster has a heap of at most k papers, so this takes time
+    proportional to the number of papers times log(k), however large the clusters are.
+    '''
+    heaps = {}
+    for position, (paper, cluster, weight) in enumerate(zip(papers, clusters, weights)):
+        # Papers without a proper weight come last
+        if weight != weight:
+            weight = float('-inf')
+        item = (weight, -position, paper)
+        heap = heaps.setdefault(cluster, [])
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return dict((cluster, [item[2] for item in sorted(heap, reverse=True)]) for cluster, heap in heaps.items())
+
+def _diversity_keys(candidate, diversity):
+    '''
+    The attribute values of a candidate that should not occur twice in a batch
+    '''
+    keys = set()
+    for name in diversity:
+        value = DIVERSITY_ATTRIBUTES[name](candidate)
+        if value is not None:
+            keys.add((name, value))
+    return keys
+
+def select_batches(ranked, batch_size=5, num_batches=1, diversity=DEFAULT_DIVERSITY, rnd=None):
+    '''
+    Choose up to 'num_batches' batches of (at most) 'batch_size' candidates, from the candidates
+    ranked per cluster (see top_papers). A batch takes at most one candidate per cluster, going
+    through the clusters in random order, and from each cluster the best remaining candidate that
+    shares none of the 'diversity' attributes (see DIVERSITY_ATTRIBUTES) with the candidates already
+    in the batch. If that leaves the batch short, it is filled up without this constraint. Every
+    candidate is used once. Returns a list of batches, each a list of (cluster, bibcode) tuples.
+    '''
+    if rnd is None:
+        rnd = random
+    for name in diversity:
+        if name not in DIVERSITY_ATTRIBUTES:
+            raise ValueError('Unknown diversity attribute "{0}", choose from {1}'.format(name, ", ".join(sorted(DIVERSITY_ATTRIBUTES))))
+    remaining = dict((cluster, list(candidates)) for cluster, candidates in ranked.items())
+    batches = []
+    for i in range(num_batches):
+        clusters = [cluster for cluster in remaining if len(remaining[cluster]) > 0]
+        rnd.shuffle(clusters)
+        batch = []
+        taken = set()
+        for strict in (True, False):
+            for cluster in clusters:
+                if len(batch) == batch_size:
+                    break
+                for position, candidate in enumerate(remaining[cluster]):
+                    keys = _diversity_keys(candidate, diversity)
+                    if strict and len(keys & taken) > 0:
+                        continue
+                    batch.append((cluster, candidate.bibcode))
+                    taken.update(keys)
+                    del remaining[cluster][position]
+                    break
+            # Clusters that contributed to the batch are done for this batch
+            chosen = set(cluster for cluster, bibcode in batch)
+            clusters = [cluster for cluster in clusters if cluster not in chosen]
+        if len(batch) == 0:
+            break
+        batches.append(batch)
+    return batches
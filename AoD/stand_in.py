@@ -0,0 +1,219 @@
+'''
+Local stand-in for the services used by the Article of the Day (the ADS search and libraries API,
+Slack and Twitter), to exercise the 'generate' and 'post' commands end to end without live
+services. Latency, errors and the size of the corpus are configurable (see the STAND_IN_*
+settings in config.py), and the /stats endpoint reports the throughput and latency per endpoint.
+
+Run it with "python stand_in.py" and point the application at it in local_config.py:
+
+    SOLR_PATH = 'http://localhost:5001/v1/search/query'
+    LIBRARY_PATH = 'http://localhost:5001/v1/biblib'
+    SLACK_END_POINT = 'http://localhost:5001/slack'
+    TWITTER_SINK_URL = 'http://localhost:5001/twitter/statuses/update'
+'''
+import time
+import random
+import threading
+from collections import defaultdict
+
+from flask import Blueprint, current_app, jsonify, request, g
+
+from app import create_app
+import synthetic
+
+blueprint = Blueprint('stand_in', __name__)
+
+class StandInState(object):
+    """The corpus, the libraries and the statistics of the stand-in"""
+
+    def __init__(self, config):
+        """Constructor"""
+        seed = config.get('STAND_IN_SEED')
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        # The search results are sorted by (normalized) citations, like the real query
+        docs = synthetic.solr_docs(config.get('STAND_IN_CORPUS_SIZE'), seed=seed)
+        self.docs = sorted(docs, key=lambda d: d['citation_count'], reverse=True)
+        self.documents = dict((d['bibcode'], d) for d in self.docs)
+        # The library with the articles posted earlier and the batch library
+        posted = self.rnd.sample([d['bibcode'] for d in self.docs], min(config.get('STAND_IN_POSTED'), len(self.docs)))
+        batch = [d['bibcode'] for d in self.docs if d['bibcode'] not in set(posted)][:5]
+        self.libraries = {}
+        for name, bibcodes in [(config.get('AOD_LIBRARY_NAME'), posted), (config.get('BATCH_LIBRARY_NAME'), batch)]:
+            libid = 'lib%04d' % len(self.libraries)
+            self.libraries[libid] = {'id': libid, 'name': name, 'bibcodes': list(bibcodes)}
+        # Messages received by the sinks
+        self.slack = []
+        self.tweets = []
+        # The handling times and the number of errors per endpoint
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.started = time.time()
+
+    def record(self, endpoint, seconds, error):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if error:
+                self.errors[endpoint] += 1
+
+    def stats(self):
+        """The number of requests, errors and latency percentiles (in seconds) per endpoint"""
+        with self.lock:
+            elapsed = time.time() - self.started
+            endpoints = {}
+            for endpoint, latencies in self.latencies.items():
+                latencies = sorted(latencies)
+                percentile = lambda p: latencies[min(len(latencies) - 1, int(p*len(latencies)))]
+                endpoints[endpoint] = {
+                    'requests': len(latencies),
+                    'errors': self.errors[endpoint],
+                    'requests_per_second': len(latencies)/elapsed,
+                    'p50': percentile(0.5),
+                    'p95': percentile(0.95),
+                    'p99': percentile(0.99),
+                    'max': latencies[-1],
+                }
+            return {'elapsed': elapsed, 'endpoints': endpoints,
+                    'slack_messages': len(self.slack), 'tweets': len(self.tweets)}
+
+def _state():
+    return current_app.extensions['stand_in']
+
+def _select_fields(doc, fl):
+    '''
+    The fields of a document requested with the 'fl' parameter
+    '''
+    if not fl:
+        return dict(doc)
+    fields = [f.strip() for f in fl.split(',')]
+    return dict((f, doc[f]) for f in fields if f in doc)
+
+@blueprint.before_app_request
+def _inject_latency_and_errors():
+    # Every request (except for the statistics) gets a random delay, with a lognormal
+    # distribution to get a realistic tail, and fails with the configured probability
+    g.start = time.time()
+    if request.endpoint == 'stand_in.stats':
+        return None
+    state = _state()
+    latency = current_app.config.get('STAND_IN_LATENCY')
+    if latency:
+        with state.lock:
+            delay = latency * state.rnd.lognormvariate(0, current_app.config.get('STAND_IN_LATENCY_SIGMA'))
+        time.sleep(delay)
+    with state.lock:
+        failure = state.rnd.random() < current_app.config.get('STAND_IN_ERROR_RATE')
+    if failure:
+        response = jsonify({'error': 'Injected error'})
+        response.status_code = 503
+        return response
+    return None
+
+@blueprint.after_app_request
+def _record_request(response):
+    if request.endpoint != 'stand_in.stats':
+        _state().record(request.endpoint or request.path, time.time() - g.start, response.status_code >= 400)
+    return response
+
+@blueprint.route('/v1/search/query', methods=['GET'])
+def search():
+    # Only the paging of the query is supported (with 'start' or a cursor), the query itself is ignored
+    state = _state()
+    rows = int(request.args.get('rows', 10))
+    cursor = request.args.get('cursorMark')
+    start = int(request.args.get('start', 0))
+    if cursor is not None:
+        start = 0 if cursor == '*' else int(cursor)
+    docs = [_select_fields(d, request.args.get('fl')) for d in state.docs[start:start + rows]]
+    result = {
+        'responseHeader': {'status': 0, 'params': request.args.to_dict()},
+        'response': {'numFound': len(state.docs), 'start': start, 'docs': docs},
+    }
+    if cursor is not None:
+        # The next cursor equals the current one at the end of the results
+        result['nextCursorMark'] = str(start + len(docs)) if len(docs) > 0 else cursor
+    return jsonify(result)
+
+@blueprint.route('/v1/biblib/libraries', methods=['GET'])
+def libraries():
+    state = _state()
+    with state.lock:
+        data = [{'id': lib['id'], 'name': lib['name'], 'num_documents': len(lib['bibcodes'])}
+                for lib in state.libraries.values()]
+    return jsonify({'libraries': data})
+
+@blueprint.route('/v1/biblib/libraries/<libid>', methods=['GET'])
+def library(libid):
+    state = _state()
+    with state.lock:
+        if libid not in state.libraries:
+            return jsonify({'error': 'Library {0} does not exist'.format(libid)}), 404
+        lib = state.libraries[libid]
+        bibcodes = list(lib['bibcodes'])
+    # Like the libraries API, the records are sorted by date (newest first) unless they are
+    # requested by the time they were added
+    sort = request.args.get('sort', 'date desc')
+    if sort == 'time desc':
+        bibcodes.reverse()
+    elif sort != 'time asc':
+        bibcodes.sort(reverse=True)
+    rows = int(request.args.get('rows', 20))
+    start = int(request.args.get('start', 0))
+    page = bibcodes[start:start + rows]
+    docs = [_select_fields(state.documents.get(b, {'bibcode': b}), request.args.get('fl')) for b in page]
+    return jsonify({
+        'metadata': {'id': libid, 'name': lib['name'], 'num_documents': len(bibcodes)},
+        'solr': {'response': {'numFound': len(bibcodes), 'start': start, 'docs': docs}},
+        'documents': page,
+    })
+
+@blueprint.route('/v1/biblib/documents/<libid>', methods=['POST'])
+def documents(libid):
+    state = _state()
+    data = request.get_json(force=True)
+    with state.lock:
+        if libid not in state.libraries:
+            return jsonify({'error': 'Library {0} does not exist'.format(libid)}), 404
+        bibcodes = state.libraries[libid]['bibcodes']
+        if data.get('action') == 'remove':
+            remove = set(data.get('bibcode', []))
+            state.libraries[libid]['bibcodes'] = [b for b in bibcodes if b not in remove]
+            return jsonify({'number_removed': len(bibcodes) - len(state.libraries[libid]['bibcodes'])})
+        present = set(bibcodes)
+        added = [b for b in data.get('bibcode', []) if b not in present]
+        bibcodes.extend(added)
+        return jsonify({'number_added': len(added)})
+
+@blueprint.route('/slack', methods=['POST'])
+def slack():
+    state = _state()
+    with state.lock:
+        state.slack.append(request.get_json(force=True))
+    return 'ok'
+
+@blueprint.route('/twitter/statuses/update', methods=['POST'])
+def tweet():
+    state = _state()
+    status = request.get_json(force=True).get('status')
+    with state.lock:
+        state.tweets.append(status)
+        tweet_id = len(state.tweets)
+    return jsonify({'id': tweet_id, 'text': status})
+
+@blueprint.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(_state().stats())
+
+def create_stand_in_app():
+    """
+    Create the stand-in application, with the same configuration as the application itself
+    :return: flask.Flask application
+    """
+    app = create_app()
+    app.extensions['stand_in'] = StandInState(app.config)
+    app.register_blueprint(blueprint)
+    return app
+
+if __name__ == "__main__":
+    app = create_stand_in_app()
+    app.run(port=app.config.get('STAND_IN_PORT'), threaded=True, use_reloader=False)
@@ -0,0 +1,69 @@
+'''
+Synthetic ADS data, for benchmarks and for the local stand-in of the ADS API
+'''
+import math
+import random
+import string
+
+JOURNALS = ['ApJ', 'ApJS', 'ApJL', 'AJ', 'MNRAS', 'A&A', 'PASP', 'Icar', 'SoPh', 'Natur']
+
+def _bibcode(journal, number, initial, year=2020):
+    '''
+    A bibcode in the ADS format (year, journal, volume, page, initial of the first author). The
+    volume and page are derived from 'number', so that different numbers give different bibcodes.
+    '''
+    volume = str(900 + number // 9999).rjust(4, '.')
+    page = str(1 + number % 9999).rjust(4, '.')
+    return '%s%s%s.%s%s' % (year, journal.ljust(5, '.'), volume, page, initial)
+
+def solr_docs(num_papers, mean_references=20, reference_sigma=0.8, max_references=250,
+              citations_per_reference=4.0, overlap=0.7, num_topics=None, vocabulary_size=5000,
+              no_reference_fraction=0.1, seed=42):
+    '''
+    Generate Solr documents for a synthetic corpus. The papers are divided into topics. Every paper
+    cites a lognormally distributed number of references (with the specified mean), and a fraction
+    'overlap' of these references is drawn from a pool specific to its topic, the remainder from
+    the pool of all references. The size of the reference pool follows from the average number of
+    papers citing a reference. The titles are drawn from a vocabulary with a Zipf distribution,
+    in which the ranking of the words depends on the topic. The bibcodes follow the ADS format,
+    spread over a number of journals.
+    '''
+    rnd = random.Random(seed)
+    if num_topics is None:
+        num_topics = max(1, num_papers // 250)
+    num_references = max(1, int(num_papers * mean_references / citations_per_reference))
+    topic_size = max(1, num_references // num_topics)
+    vocabulary = sorted(set(''.join(rnd.choice(string.ascii_lowercase) for i in range(rnd.randint(3, 12)))
+                            for w in range(vocabulary_size)))
+    word_weights = [1.0/(rank + 1) for rank in range(len(vocabulary))]
+    # The lognormal distribution with this 'mu' has the requested mean
+    mu = math.log(mean_references) - reference_sigma**2/2.0
+    docs = []
+    for i in range(num_papers):
+        topic = rnd.randrange(num_topics)
+        doc = {
+            'bibcode': _bibcode(rnd.choice(JOURNALS), i, rnd.choice(string.ascii_uppercase)),
+            'year': '2020',
+            'citation_count': int(rnd.paretovariate(1.5)) - 1,
+            'read_count': int(10*rnd.paretovariate(1.2)),
+            'author_count': rnd.randint(1, 20),
+            'cite_read_boost': round(rnd.random(), 3),
+            'first_author': 'Author, %s.' % rnd.choice(string.ascii_uppercase),
+        }
+        doc['first_author_norm'] = doc['first_author']
+        # The topic shifts the ranking of the words in the vocabulary
+        offset = topic * len(vocabulary) // num_topics
+        words = rnd.choices(range(len(vocabulary)), weights=word_weights, k=rnd.randint(5, 15))
+        doc['title'] = [' '.join(vocabulary[(w + offset) % len(vocabulary)] for w in words)]
+        if rnd.random() >= no_reference_fraction:
+            count = min(max_references, max(1, int(rnd.lognormvariate(mu, reference_sigma))))
+            references = set()
+            for r in range(count):
+                if rnd.random() < overlap:
+                    ref = topic*topic_size + rnd.randrange(topic_size)
+                else:
+                    ref = rnd.randrange(num_references)
+                references.add('2000Ref.%010d' % ref)
+            doc['reference'] = sorted(references)
+        docs.append(doc)
+    return docs
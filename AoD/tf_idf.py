@@ -8,7 +8,7 @@ punctuation_regex = re.compile('[%s]' % re.escape(string.punctuation))
 
 markup_regex = re.compile(r".*sub.*sub|.*sup.*sup")
 
-tiny_stopword_list = ["and", "or", "an", "a", "as", "at", "of", "to", "on", "for", "be", "from", "in", "by", "with", "the", "not", "but"]
+tiny_stopword_list = frozenset(["and", "or", "an", "a", "as", "at", "of", "to", "on", "for", "be", "from", "in", "by", "with", "the", "not", "but"])
 
 def tokenize(list_of_titles):
     l = " ".join(list_of_titles)
@@ -37,6 +37,23 @@ def is_number(s):
     except ValueError:
         return False
 
+def merge_prefixes(freq_dict):
+    """
+    Add the frequency of every word to that of the shortest word (of more than 3 letters)
+    it starts with, setting the frequency of the merged words to zero. In a sorted word list
+    the words starting with a given word directly follow that word, so a single pass suffices.
+    """
+    prefix = None
+    for w in sorted(freq_dict):
+        if prefix is not None and w.startswith(prefix):
+            freq_dict[prefix] += freq_dict[w]
+            freq_dict[w] = 0
+        elif len(w) > 3:
+            prefix = w
+        else:
+            prefix = None
+    return freq_dict
+
 def get_tf_idf_vals(title_dict):
     return_dict = {}
     word_dict = {tup[0] : tokenize(tup[1]) for tup in title_dict.items()}
@@ -52,11 +69,7 @@ def get_tf_idf_vals(title_dict):
             if is_number(f):
                 freq_dict[f] = 0
         #now, a hacky way to avoid showing similar words without going to the trouble of stemming
-        for f in freq_dict:
-            for f2 in freq_dict:
-                if f != f2 and f in f2[:len(f)] and len(f) > 3 :
-                    freq_dict[f] =  freq_dict[f] + freq_dict[f2]
-                    freq_dict[f2] = 0
+        merge_prefixes(freq_dict)
         final_dict = {}
         for f in freq_dict:
             final_dict[f.encode("utf-8")] = freq_dict[f] * idf_dict[f]
@@ -3,10 +3,19 @@ from flask import request
 import sys
 import os
 import json
+import gzip
+import hashlib
+from datetime import datetime
 from client import client
+import posted_index
+import local_files
+import batch_journal
 import requests
 import math
+import time
+import threading
 import tweepy
+from concurrent.futures import ThreadPoolExecutor
 
 class NoSuchLibrary(Exception):
     pass
@@ -19,6 +28,32 @@ class SolrErrorStatus(Exception):
 class EmptyBatchLibrary(Exception):
     pass
 
+class TwitterSink(object):
+    """Stand-in for the Twitter API, which posts the status to a URL instead (see stand_in.py)"""
+
+    def __init__(self, url):
+        """Constructor"""
+        self.url = url
+
+    def update_status(self, status):
+        response = client().post(self.url, data=json.dumps({'status': status}),
+                                 headers={'Content-Type': 'application/json'})
+        if response.status_code != 200:
+            raise ValueError('Request to Twitter sink returned an error %s, the response is:\n%s'
+                             % (response.status_code, response.text))
+        return response.json()
+
+# In-process cache of library IDs, by library name
+_library_id_cache = None
+_library_id_lock = threading.RLock()
+
+# The Twitter API object, created once per process
+_twitter_api = None
+_twitter_api_lock = threading.Lock()
+
+# The worker that syncs the batch journal with the batch library in the background
+_journal_sync_executor = ThreadPoolExecutor(max_workers=1)
+
 def get_data(yrange):
     # Get the information from Solr
     # The specification of the year range is just to prevent older material
@@ -29,14 +64,179 @@ def get_data(yrange):
               'fl': current_app.config.get('FIELDS'),
               'sort': 'citation_count_norm desc',
               'rows': current_app.config.get('MAX_HITS')}
+    # Reruns on the same day use the snapshot of an earlier run, if it is recent enough
+    snapshot = get_snapshot_path(params)
+    if _is_fresh_snapshot(snapshot):
+        current_app.logger.info('Using Solr data from snapshot {0}'.format(snapshot))
+        return read_snapshot(snapshot)
     response = client().get(current_app.config.get('SOLR_PATH'), params=params)
     if response.status_code != 200:
         raise SolrErrorStatus("Solr return status code {0}: {1}".format(response.status_code, response.text))
     resp = response.json()
     # Collect meta data
-    return resp['response']['docs']
+    docs = resp['response']['docs']
+    if current_app.config.get('SNAPSHOT_TTL'):
+        try:
+            save_snapshot(snapshot, docs)
+        except:
+            current_app.logger.exception('Unable to save Solr data snapshot {0}'.format(snapshot))
+    return docs
+
+def get_snapshot_path(params):
+    # Snapshots are keyed by the query, the fields, the sort, the number of rows and the date
+    key = json.dumps([params['q'], params['fl'], params['sort'], params['rows'], datetime.now().strftime('%Y-%m-%d')])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    filename = "solr_%s_%s.json.gz" % (datetime.now().strftime('%Y%m%d'), digest[:12])
+    return os.path.join(current_app.config.get('SNAPSHOT_DIR'), filename)
+
+def _is_fresh_snapshot(path):
+    # Whether a snapshot exists that is recent enough to be reused (see SNAPSHOT_TTL)
+    ttl = current_app.config.get('SNAPSHOT_TTL')
+    return bool(ttl) and os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl
+
+def prune_snapshots(directory, keep=None):
+    # Remove the snapshots that are older than SNAPSHOT_RETENTION seconds (except for 'keep'),
+    # so that the snapshot directory does not keep growing
+    retention = current_app.config.get('SNAPSHOT_RETENTION')
+    if not retention or not os.path.isdir(directory):
+        return 0
+    removed = 0
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if not filename.startswith('solr_') or path == keep:
+            continue
+        try:
+            if time.time() - os.path.getmtime(path) > retention:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            current_app.logger.exception('Unable to remove old snapshot {0}'.format(path))
+    if removed > 0:
+        current_app.logger.info('Removed {0} old snapshots from {1}'.format(removed, directory))
+    return removed
+
+def save_snapshot(path, docs):
+    # Store Solr data as compressed JSON (replacing the file atomically, so that an interrupted
+    # write does not leave a corrupt snapshot behind). Snapshots older than SNAPSHOT_RETENTION
+    # are removed.
+    local_files.write_json(path, docs, compress=True)
+    prune_snapshots(os.path.dirname(path), keep=path)
+
+def stream_snapshot(path, docs):
+    # Store Solr data as compressed JSON while it is being consumed, passing on the documents
+    # one by one. The snapshot is only stored when all documents were consumed; when it cannot
+    # be written, the documents are passed on without it.
+    try:
+        snapshot = local_files.AtomicFile(path, 'wt', compress=True)
+        snapshot.file.write('[')
+    except:
+        current_app.logger.exception('Unable to save Solr data snapshot {0}'.format(path))
+        snapshot = None
+    try:
+        for num_docs, doc in enumerate(docs):
+            if snapshot is not None:
+                try:
+                    snapshot.file.write(', ' if num_docs > 0 else '')
+                    json.dump(doc, snapshot.file)
+                except:
+                    current_app.logger.exception('Unable to save Solr data snapshot {0}'.format(path))
+                    snapshot.discard()
+                    snapshot = None
+            yield doc
+        if snapshot is not None:
+            try:
+                snapshot.file.write(']')
+                snapshot.commit()
+                snapshot = None
+                prune_snapshots(os.path.dirname(path), keep=path)
+            except:
+                current_app.logger.exception('Unable to save Solr data snapshot {0}'.format(path))
+    finally:
+        # The documents were not all consumed (or writing failed), so the snapshot is incomplete
+        if snapshot is not None:
+            snapshot.discard()
+
+def read_snapshot(path):
+    # Read Solr data stored as compressed JSON
+    with gzip.open(path, 'rt') as f:
+        return json.load(f)
+
+def stream_data(yrange):
+    # Get the information from Solr, page by page, using a cursor
+    # This generator yields the Solr documents one by one, so that the candidate pool
+    # can be larger than what can be retrieved in a single request
+    query = current_app.config.get('QUERY') + " year:%s" % yrange
+    page_size = current_app.config.get('SOLR_PAGE_SIZE')
+    max_docs = current_app.config.get('SOLR_MAX_DOCS')
+    # Deep paging with a cursor requires the sort to include the unique key
+    params = {'wt': 'json',
+               'q': query,
+              'fl': current_app.config.get('FIELDS'),
+              'sort': current_app.config.get('SOLR_CURSOR_SORT'),
+              'cursorMark': '*'}
+    # Like with get_data, the streamed documents are stored in a snapshot, which is used by
+    # reruns on the same day (and can be replayed with --from-snapshot)
+    snapshot = get_snapshot_path(dict(params, rows=max_docs))
+    if _is_fresh_snapshot(snapshot):
+        current_app.logger.info('Using Solr data from snapshot {0}'.format(snapshot))
+        for doc in read_snapshot(snapshot):
+            yield doc
+        return
+    docs = _stream_pages(params, page_size, max_docs)
+    if current_app.config.get('SNAPSHOT_TTL'):
+        docs = stream_snapshot(snapshot, docs)
+    for doc in docs:
+        yield doc
+
+def _stream_pages(params, page_size, max_docs):
+    # Retrieve the documents page by page, until 'max_docs' documents have been retrieved or
+    # the cursor does not move anymore
+    num_docs = 0
+    while num_docs < max_docs:
+        params['rows'] = min(page_size, max_docs - num_docs)
+        response = client().get(current_app.config.get('SOLR_PATH'), params=params)
+        if response.status_code != 200:
+            raise SolrErrorStatus("Solr return status code {0}: {1}".format(response.status_code, response.text))
+        resp = response.json()
+        docs = resp['response']['docs']
+        for doc in docs:
+            yield doc
+        num_docs += len(docs)
+        # When the cursor does not change anymore, we have retrieved all results
+        next_cursor = resp.get('nextCursorMark', params['cursorMark'])
+        if len(docs) == 0 or next_cursor == params['cursorMark']:
+            break
+        params['cursorMark'] = next_cursor
+
+def _get_library_id_cache():
+    # The in-process cache of library IDs is initialized from the cache on disk
+    global _library_id_cache
+    with _library_id_lock:
+        if _library_id_cache is None:
+            _library_id_cache = local_files.read_json(current_app.config.get('LIBRARY_ID_CACHE_FILE'), {})
+        return _library_id_cache
+
+def _save_library_id_cache():
+    try:
+        local_files.write_json(current_app.config.get('LIBRARY_ID_CACHE_FILE'), _library_id_cache)
+    except:
+        current_app.logger.exception('Unable to save the library ID cache')
+
+def invalidate_library_id(libid):
+    # Remove a library ID from the cache, e.g. when a call using it returned a 404
+    cache = _get_library_id_cache()
+    with _library_id_lock:
+        for libname in [name for name, entry in cache.items() if entry['id'] == libid]:
+            del cache[libname]
+        _save_library_id_cache()
 
 def get_library_id(token, libname):
+    # Library names are resolved from the cache when possible. Entries expire after
+    # LIBRARY_ID_CACHE_TTL seconds.
+    cache = _get_library_id_cache()
+    entry = cache.get(libname)
+    if entry and time.time() - entry['time'] < current_app.config.get('LIBRARY_ID_CACHE_TTL'):
+        return entry['id']
     library_url = "%s/libraries" % (current_app.config.get('LIBRARY_PATH'))
     response = client().get(library_url)
     if response.status_code != 200:
@@ -48,40 +248,70 @@ def get_library_id(token, libname):
         # We did not find a library with this name.
         current_app.logger.exception('Unable to find library "{0}" among libraries'.format(libname))
         raise NoSuchLibrary('Unable to find library "{0}" among libraries'.format(libname))
+    # We got the complete listing, so we can cache the IDs of all libraries
+    with _library_id_lock:
+        for d in data:
+            cache[d['name']] = {'id': d['id'], 'time': time.time()}
+        _save_library_id_cache()
     return libdata['id']
 
-def get_library(token, libid, rows=100, start=0, with_metadata=False):
+def _get_library_page(libid, params):
+    # Retrieve a single page of the contents of a library
+    library_url = "%s/libraries/%s" % (current_app.config.get('LIBRARY_PATH'), libid)
+    response = client().get(library_url, params=params)
+    if response.status_code == 404:
+        # The library ID is no longer valid, so it should not be used anymore
+        invalidate_library_id(libid)
+        raise NoSuchLibraryID('Library ID {0} not found'.format(libid))
+    return response.json()
+
+def get_library(token, libid, rows=None, start=0, with_metadata=False):
     # Retrieve the contents of the library specified
     # rows: the number of records to retrieve per call (in general, we cannot retrieve everything in one call)
+    num_documents, documents = _get_library_contents(libid, rows=rows, start=start)
+    if not with_metadata:
+        return [d['bibcode'] for d in documents]
+    else:
+        return documents
+
+def _get_library_contents(libid, rows=None, start=0, sort=None):
+    # Retrieve the contents of the library specified, starting at position 'start', together
+    # with the total number of records in the library. Without a 'sort', the records are in
+    # the default order of the libraries API (by publication date).
+    if rows is None:
+        rows = current_app.config.get('LIBRARY_PAGE_SIZE')
     params = {
         'rows': rows,
         'start': start,
         'fl': 'bibcode,title,first_author_norm, author_count'
     }
-    library_url = "%s/libraries/%s" % (current_app.config.get('LIBRARY_PATH'), libid)
-    response = client().get(library_url, params=params)
-    data = response.json()
+    if sort:
+        params['sort'] = sort
+    data = _get_library_page(libid, params)
     # The metadata in the header tells us how many records this library contains
     num_documents = data['metadata']['num_documents']
     # Get the results contained in this first request
     documents = data['solr']['response']['docs']
-    # The number of rows in the requests and the number of records in the library specifies how often to paginate
-    num_paginates = int(math.ceil((num_documents) / (1.0*rows)))
-    # Update the start position with the number of records we have retrieved so far
-    start += rows
-    # Start retrieving the remainder of the contents
-    for i in range(num_paginates):
-        params['start'] = start
-        response = client().get(library_url, params=params)
-        data = response.json()
-        # Add the bibcodes from this batch to the collection
-        documents.extend(data['solr']['response']['docs'])
-        # Update the start position for the next batch
-        start += rows
-    if not with_metadata:
-        return [d['bibcode'] for d in documents]
-    else:
-        return documents
+    # The number of rows in the requests and the number of records left after the first request
+    # specifies how often to paginate
+    num_paginates = max(0, int(math.ceil((num_documents - start) / (1.0*rows))) - 1)
+    # The start positions of the remaining pages
+    starts = [start + rows*(i + 1) for i in range(num_paginates)]
+    if len(starts) > 0:
+        # Retrieve the remainder of the contents concurrently. The worker threads need their own
+        # application context to be able to use the client.
+        app = current_app._get_current_object()
+        def get_page(page_start):
+            page_params = dict(params, start=page_start)
+            with app.app_context():
+                return _get_library_page(libid, page_params)['solr']['response']['docs']
+        max_workers = min(current_app.config.get('LIBRARY_FETCH_CONCURRENCY'), len(starts))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # 'map' returns the pages in the order of the start positions
+            for docs in executor.map(get_page, starts):
+                # Add the bibcodes from this batch to the collection
+                documents.extend(docs)
+    return num_documents, documents
 
 def update_library(token, bibcodes, libid, action='add'):
     library_url = "%s/documents/%s" % (current_app.config.get('LIBRARY_PATH'), libid)
@@ -98,9 +328,50 @@ def update_library(token, bibcodes, libid, action='add'):
         'Accept': 'text/plain',
     }
     response = client().post(library_url, data=json.dumps(params), headers=headers)
+    if response.status_code == 404:
+        # The library ID is no longer valid, so it should not be used anymore
+        invalidate_library_id(libid)
+        raise NoSuchLibraryID('Library ID {0} not found'.format(libid))
     return response.json()
 
-def cleanup_data(data):
+def get_prior_articles(library_id, resync=False, offline=False):
+    # Get the bibcodes of all articles posted earlier, from the local index. The index is first
+    # synced with the library, by retrieving only the records added since the last sync.
+    # The number of records in the library serves as the watermark for the sync, which only
+    # works when the records are sorted by the time they were added (LIBRARY_SYNC_SORT).
+    # In offline mode, the index is used as it is.
+    index = posted_index.PostedIndex(current_app.config.get('POSTED_INDEX_FILE'))
+    try:
+        if offline:
+            return index.bibcodes()
+        sort = current_app.config.get('LIBRARY_SYNC_SORT')
+        max_age = current_app.config.get('POSTED_INDEX_RESYNC_AGE')
+        if resync or time.time() - index.last_full_sync() > max_age:
+            index.reset()
+        watermark = index.watermark()
+        num_documents, documents = _get_library_contents(library_id, start=watermark, sort=sort)
+        if num_documents < watermark:
+            # The library has shrunk, so the index is out of date: do a full resync
+            current_app.logger.info('Library {0} has fewer records than the local index, resyncing'.format(library_id))
+            index.reset()
+            num_documents, documents = _get_library_contents(library_id, sort=sort)
+        index.add([d['bibcode'] for d in documents], num_documents)
+        if index.size() != num_documents:
+            # The tail did not contain the records we expected (e.g. because the order of the
+            # records changed), so the index is out of date: do a full resync
+            current_app.logger.info('Local index out of sync with library {0}, resyncing'.format(library_id))
+            index.reset()
+            num_documents, documents = _get_library_contents(library_id, sort=sort)
+            index.add([d['bibcode'] for d in documents], num_documents)
+        return index.bibcodes()
+    finally:
+        index.close()
+
+def cleanup_data(data, resync=False, offline=False):
+    # In offline mode, we only use the local index of articles posted earlier
+    if offline:
+        prior_articles = get_prior_articles(None, offline=True)
+        return (d for d in data if d['bibcode'] not in prior_articles)
     api_token = current_app.config.get('API_TOKEN')
     library_name= current_app.config.get('AOD_LIBRARY_NAME')
     try:
@@ -110,12 +381,13 @@ def cleanup_data(data):
         raise NoSuchLibraryID('Unable to find library ID for "{0}"'.format(library_name))
     # Get the bibcodes of all articles posted earlier as ADS Article of the Day
     try:
-        prior_articles = get_library(api_token, library_id)
+        prior_articles = get_prior_articles(library_id, resync=resync)
     except:
         current_app.logger.exception('Unable to get prior articles for "{0}" using library ID {1}'.format(library_name, library_id))
         raise LibraryRetrievalException('Unable to get prior articles for "{0}" using library ID {1}'.format(library_name, library_id))
     # Remove these from the current set (if present)
-    data = [d for d in data if d['bibcode'] not in prior_articles]
+    # The data is filtered lazily, so that it can be consumed as a stream
+    data = (d for d in data if d['bibcode'] not in prior_articles)
     return data
 
 def save_new_batch(batch):
@@ -130,36 +402,68 @@ def save_new_batch(batch):
         library_id = get_library_id(api_token, library_name)
     except:
         raise Exception('Unable to find library ID for "%s"' % library_name)
+    # The articles of the previous batch that were not taken from the journal no longer apply. The
+    # articles that were taken but not removed from the batch library yet are kept, so that they
+    # are not posted again.
+    journal_file = current_app.config.get('BATCH_JOURNAL_FILE')
+    pending = []
+    if journal_file:
+        journal = batch_journal.BatchJournal(journal_file)
+        try:
+            journal.discard_remaining()
+            pending = journal.pending_removals()
+        finally:
+            journal.close()
     # First double check that batch library is empty
     try:
         prior_articles = get_library(api_token, library_id)
     except:
         current_app.logger.exception('Unable to get prior articles for "{0}" using library ID {1}'.format(library_name, library_id))
         raise LibraryRetrievalException('Unable to get prior articles for "{0}" using library ID {1}'.format(library_name, library_id))
+    prior_removed = True
     if len(prior_articles) > 0:
         current_app.logger.info('Batch library {0} still has articles in it! Attempting to remove.'.format(library_id))
         try:
             res = update_library(api_token, prior_articles, library_id, action='remove')
+            prior_removed = 'number_removed' in res
         except:
             current_app.logger.exception('Failed to remove existing articles in batch library {0}'.format(library_id))
+            prior_removed = False
+        if prior_removed and journal_file:
+            journal = batch_journal.BatchJournal(journal_file)
+            try:
+                journal.mark_synced(pending)
+            finally:
+                journal.close()
     # Update this library with the bibcodes
     res = update_library(api_token, bibcodes, library_id)
+    # Keep a local journal of the new batch, with the metadata needed to post its articles. When
+    # the articles of the previous batch are still in the batch library, the journal cannot tell
+    # them apart from the new batch, so the batch library is used directly.
+    if journal_file and not prior_removed:
+        current_app.logger.error('Not writing the journal of the new batch, the batch library still has prior articles')
+    elif journal_file:
+        try:
+            write_batch_journal(journal_file, library_id, exclude=set(pending) | _posted_articles())
+        except:
+            current_app.logger.exception('Unable to write the journal of the new batch, the batch library will be used directly')
     # Store the URL of this library to be used later on in a post on Slack
     res['library_url'] = "%s/%s" % (current_app.config.get('ADS_LIBRARY_PATH'), library_id)
     return res
 
-def update_main_library(bibcode):
+def update_main_library(bibcode, library_id=None):
     # Get the list of bibcodes in this batch
     bibcodes = [bibcode]
     # We will need to API token to interact with the ADS Libraries system
     api_token = current_app.config.get('API_TOKEN')
     # Get the name of the library used to store the batch
     library_name= current_app.config.get('AOD_LIBRARY_NAME')
-    # Determine which library identifier it has
-    try:
-        library_id = get_library_id(api_token, library_name)
-    except:
-        raise Exception('Unable to find library ID for "%s"' % library_name)
+    # Determine which library identifier it has (unless the caller already did)
+    if library_id is None:
+        try:
+            library_id = get_library_id(api_token, library_name)
+        except:
+            raise Exception('Unable to find library ID for "%s"' % library_name)
     # Update this library with the bibcodes
     res = update_library(api_token, bibcodes, library_id)
     return res
@@ -178,17 +482,142 @@ def post_to_slack(slack_data):
         )
     return 'success'
 
-def retrieve_article():
+def _posted_articles():
+    # The bibcodes of the articles posted earlier: the local index, synced with the main library
+    # (or as it is, when that fails)
+    try:
+        library_id = get_library_id(current_app.config.get('API_TOKEN'), current_app.config.get('AOD_LIBRARY_NAME'))
+        return get_prior_articles(library_id)
+    except:
+        current_app.logger.exception('Unable to sync the index of posted articles, using it as it is')
+        return get_prior_articles(None, offline=True)
+
+def write_batch_journal(path, library_id, exclude=frozenset()):
+    # Write the journal of the batch in the batch library, with the metadata of its articles
+    # (in the order of the library), leaving out the articles in 'exclude' (e.g. articles that
+    # were posted already)
+    articles = get_library(current_app.config.get('API_TOKEN'), library_id, with_metadata=True)
+    articles = [a for a in articles if a['bibcode'] not in exclude]
+    journal = batch_journal.BatchJournal(path)
+    try:
+        journal.replace(library_id, articles)
+    finally:
+        journal.close()
+    return len(articles)
+
+def _take_from_journal(path, library_id=None):
+    # Take the next article of the current batch from the local journal. Returns the article (None
+    # if the journal has no articles left) and the articles taken earlier that were not removed
+    # from the batch library yet. Articles that were posted already (according to the local index
+    # of posted articles) are skipped; they become pending removals as well.
+    journal = batch_journal.BatchJournal(path)
+    try:
+        if library_id is not None and journal.library_id() not in (None, library_id):
+            # The journal belongs to another library, so it cannot be used
+            current_app.logger.info('Batch journal is for another library than {0}, discarding it'.format(library_id))
+            journal.reset()
+            return None, []
+        posted = get_prior_articles(None, offline=True)
+        article = journal.take()
+        while article is not None and article['bibcode'] in posted:
+            current_app.logger.info('Skipping {0} in the batch journal, it was posted already'.format(article['bibcode']))
+            article = journal.take()
+        return article, journal.pending_removals()
+    finally:
+        journal.close()
+
+def sync_batch_journal():
+    # Remove the articles taken from the batch journal from the batch library, all in a single
+    # request. Failed requests are retried with an exponential backoff; the removals that keep
+    # failing stay in the journal, and are synced together with the removal after the next post.
+    # When a removal has failed BATCH_JOURNAL_SYNC_ALERT times, this is reported on Slack.
+    journal = batch_journal.BatchJournal(current_app.config.get('BATCH_JOURNAL_FILE'))
+    try:
+        library_id = journal.library_id()
+        bibcodes = journal.pending_removals()
+        if library_id is None or len(bibcodes) == 0:
+            return 0
+        failed_before = journal.failed_attempts()
+        api_token = current_app.config.get('API_TOKEN')
+        retries = current_app.config.get('BATCH_JOURNAL_SYNC_RETRIES')
+        backoff = current_app.config.get('BATCH_JOURNAL_SYNC_BACKOFF')
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(backoff * 2**(attempt - 1))
+            try:
+                res = update_library(api_token, bibcodes, library_id, action='remove')
+            except NoSuchLibraryID:
+                # The library is gone, so there is nothing left to remove
+                journal.mark_synced(bibcodes)
+                return 0
+            except:
+                current_app.logger.exception('Failed to remove {0} from batch library {1}'.format(", ".join(bibcodes), library_id))
+                journal.mark_failed(bibcodes)
+                continue
+            if 'number_removed' not in res:
+                current_app.logger.error('Failed to remove {0} from batch library {1}: {2}'.format(", ".join(bibcodes), library_id, res))
+                journal.mark_failed(bibcodes)
+                continue
+            journal.mark_synced(bibcodes)
+            return res['number_removed']
+        current_app.logger.error('Giving up removing {0} from batch library {1} until the next post'.format(", ".join(bibcodes), library_id))
+        # Sound the alarm once, when the number of failed attempts reaches the threshold
+        failed = journal.failed_attempts()
+        threshold = current_app.config.get('BATCH_JOURNAL_SYNC_ALERT')
+        if threshold and failed_before < threshold <= failed:
+            try:
+                post_to_slack({
+                    'text': '@edwin Failed to remove {0} from batch library {1} after {2} attempts. Please check logs.'.format(", ".join(bibcodes), library_id, failed),
+                    'link_names': 1
+                })
+            except:
+                current_app.logger.exception("Failed to post to Slack")
+        return 0
+    finally:
+        journal.close()
+
+def schedule_batch_journal_sync():
+    # Sync the batch journal in a background thread, which needs its own application context.
+    # The worker thread is joined when the process exits, so the sync is not cut short.
+    app = current_app._get_current_object()
+    def sync():
+        with app.app_context():
+            try:
+                return sync_batch_journal()
+            except:
+                app.logger.exception('Failed to sync the batch journal')
+    return _journal_sync_executor.submit(sync)
+
+def retrieve_article(library_id=None):
+    # The articles of the current batch are taken from the local journal, if there is one, so that
+    # this does not depend on the libraries API. The removal from the batch library follows in
+    # the background.
+    journal_file = current_app.config.get('BATCH_JOURNAL_FILE')
+    pending = []
+    if journal_file:
+        try:
+            article, pending = _take_from_journal(journal_file, library_id)
+        except:
+            current_app.logger.exception('Unable to read the batch journal, using the batch library')
+            article = None
+        if article is not None:
+            schedule_batch_journal_sync()
+            return article
     # Get articles in the current batch
     api_token = current_app.config.get('API_TOKEN')
     library_name= current_app.config.get('BATCH_LIBRARY_NAME')
-    try:
-        library_id = get_library_id(api_token, library_name)
-    except:
-        current_app.logger.exception('Unable to find library ID for "%s"' % library_name)
-        raise Exception('Unable to find library ID for "%s"' % library_name)
+    if library_id is None:
+        try:
+            library_id = get_library_id(api_token, library_name)
+        except:
+            current_app.logger.exception('Unable to find library ID for "%s"' % library_name)
+            raise Exception('Unable to find library ID for "%s"' % library_name)
     # Get the articles from the current batch (contents of the batch library)
     batch_articles = get_library(api_token, library_id, with_metadata=True)
+    # Articles taken from the journal that were not removed from the library yet, were posted already,
+    # just like the articles in the local index of posted articles
+    skip = set(pending) | get_prior_articles(None, offline=True)
+    batch_articles = [a for a in batch_articles if a['bibcode'] not in skip]
     if len(batch_articles) == 0:
         raise EmptyBatchLibrary('No articles found in the batch library "{0}"'.format(library_id))
     # Select the Article of the Day (the first one in the batch)
@@ -211,13 +640,25 @@ def retrieve_article():
     # We have an article of the day
     return article
 
-def post_to_twitter(art_data):
+def get_twitter_api():
+    # Authenticate to be able to do posts. The API object is created once and then reused.
+    global _twitter_api
+    with _twitter_api_lock:
+        if _twitter_api is None:
+            if current_app.config.get('TWITTER_SINK_URL'):
+                # Posts go to a sink instead of Twitter (for testing)
+                _twitter_api = TwitterSink(current_app.config.get('TWITTER_SINK_URL'))
+            else:
+                auth = tweepy.OAuthHandler(current_app.config.get('TWITTER_CONSUMER_KEY'),
+                                           current_app.config.get('TWITTER_CONSUMER_SECRET'))
+                auth.set_access_token(current_app.config.get('TWITTER_ACCESS_KEY'),
+                                      current_app.config.get('TWITTER_ACCESS_SECRET'))
+                _twitter_api = tweepy.API(auth)
+    return _twitter_api
+
+def post_to_twitter(art_data, api=None):
     # Get some essentials for posting
     tag = current_app.config.get('TWITTER_TAG')
-    consumer_key = current_app.config.get('TWITTER_CONSUMER_KEY')
-    consumer_secret = current_app.config.get('TWITTER_CONSUMER_SECRET')
-    access_key = current_app.config.get('TWITTER_ACCESS_KEY')
-    access_secret = current_app.config.get('TWITTER_ACCESS_SECRET')
     max_post_length = current_app.config.get('TWITTER_POST_LENGTH')
     max_url_length = current_app.config.get('TWITTER_URL_LENGTH')
     # Prepare the post
@@ -242,10 +683,9 @@ def post_to_twitter(art_data):
     else:
         body_length = len(body) - (max_url_length + len(tag))
         post = "%s[...]%s" % (body[:body_length],trailer)
-    # Authenticate to be able to do the post
-    auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-    auth.set_access_token(access_key, access_secret)
-    api = tweepy.API(auth)
+    # Get the (authenticated) API, if the caller did not prepare it already
+    if api is None:
+        api = get_twitter_api()
     # Do the post
     status = api.update_status(post)
     return status